@@ -0,0 +1,153 @@
+#!/usr/bin/python
+"""Micro benchmarks for the client and chunkserver data paths.  They run locally,
+without zookeeper, a master or chunkservers.
+
+bench.py chunking [size MB]   allocation and speed of splitting data into chunks
+bench.py fsync [chunks] [size KB] [writers]
+                              chunk writes per second without fsync, with one fsync per
+                              chunk and with group commit
+bench.py compression [size MB | file]
+                              speed and ratio of each chunk compression setting, on a file
+                              or on generated log lines
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import gevent
+import xxhash
+from gevent.pool import Pool
+
+import zchunkserver
+import zclient
+import zutils
+
+CHUNKSIZE = zclient.MIN_CHUNK_SIZE
+
+
+def legacy_chunks(data, chunksize):
+    """ Chunking as _write_chunks used to do it: a list of slices, each encoded again """
+    chunks = [data[x:x + chunksize] for x in range(0, len(data), chunksize)]
+    for chunk in chunks:
+        yield chunk.encode()
+
+
+def measure(name, chunks, size):
+    """ Digests every chunk like the write path does, reporting time and traced allocation """
+    tracemalloc.start()
+    start = time.time()
+    for chunk in chunks:
+        xxhash.xxh64(chunk).digest()
+    elapsed = time.time() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    gb = size / 1024. ** 3
+    print('%-10s %8.0f MB/s   peak allocation %8.1f MB per GB' % (
+        name, size / 1024. ** 2 / elapsed, peak / 1024. ** 2 / gb))
+
+
+def bench_chunking(argv):
+    size = int(argv[0]) * 1024 ** 2 if argv else 256 * 1024 ** 2
+    text = 'x' * size
+    data = text.encode()
+
+    measure('legacy', legacy_chunks(text, CHUNKSIZE), size)
+    measure('bytes', zclient.ZClient._iter_chunks(data, CHUNKSIZE), size)
+    measure('bytearray', zclient.ZClient._iter_chunks(bytearray(data), CHUNKSIZE), size)
+
+
+def write_chunks(directory, count, chunk, writers, sync):
+    """ Writes count chunk files from concurrent greenlets, calling sync(path) after each """
+
+    def write(i):
+        path = os.path.join(directory, '%d.gfs' % i)
+        with open(path, 'wb') as f:
+            f.write(chunk)
+        sync(path)
+
+    pool = Pool(writers)
+    start = time.time()
+    for i in range(count):
+        pool.spawn(write, i)
+    pool.join()
+    return time.time() - start
+
+
+def bench_fsync(argv):
+    count = int(argv[0]) if argv else 2000
+    chunk = os.urandom(int(argv[1]) * 1024 if len(argv) > 1 else 64 * 1024)
+    writers = int(argv[2]) if len(argv) > 2 else 32
+    threadpool = gevent.get_hub().threadpool
+    group_commit = zchunkserver.GroupCommit()
+
+    modes = [('no fsync', lambda path: None),
+             ('fsync', lambda path: threadpool.spawn(zchunkserver.GroupCommit.fsync, path).get()),
+             ('group', lambda path: group_commit.sync([path]))]
+    for name, sync in modes:
+        directory = tempfile.mkdtemp(dir=os.environ.get('BENCH_DIR'))
+        try:
+            elapsed = write_chunks(directory, count, chunk, writers, sync)
+        finally:
+            shutil.rmtree(directory)
+        print('%-10s %8.0f chunks/s %8.1f MB/s' % (
+            name, count / elapsed, count * len(chunk) / 1024. ** 2 / elapsed))
+
+
+def log_lines(size):
+    """ Generates size bytes of text shaped like a server log """
+    rand = random.Random(0)
+    levels = ['INFO', 'INFO', 'INFO', 'DEBUG', 'WARNING', 'ERROR']
+    lines, total = [], 0
+    while total < size:
+        line = '2016-04-%02d %02d:%02d:%02d,%03d %s chunkserver %d: %s %s in %d ms\n' % (
+            rand.randint(1, 30), rand.randint(0, 23), rand.randint(0, 59), rand.randint(0, 59),
+            rand.randint(0, 999), rand.choice(levels), rand.randint(1, 8),
+            rand.choice(['read', 'write', 'commit', 'delete']),
+            'f%04d$%%#%d' % (rand.randint(0, 9999), rand.randint(0, 99)), rand.randint(0, 500))
+        lines.append(line)
+        total += len(line)
+    return ''.join(lines).encode()[:size]
+
+
+def bench_compression(argv):
+    if argv and os.path.exists(argv[0]):
+        with open(argv[0], 'rb') as f:
+            data = f.read()
+    else:
+        data = log_lines(int(argv[0]) * 1024 ** 2 if argv else 64 * 1024 ** 2)
+    chunks = list(zclient.ZClient._iter_chunks(data, CHUNKSIZE))
+    mb = len(data) / 1024. ** 2
+
+    print('%-10s %8s %14s %14s' % ('setting', 'ratio', 'compress', 'decompress'))
+    for compression in ['zlib:1', 'zlib:6', 'zlib:9', 'lzma:0', 'lzma:6']:
+        start = time.time()
+        compressed = [zutils.compress(chunk, compression) for chunk in chunks]
+        middle = time.time()
+        for chunk in compressed:
+            zutils.decompress(chunk, compression)
+        end = time.time()
+        print('%-10s %8.2f %9.0f MB/s %9.0f MB/s' % (
+            compression, len(data) / float(sum(len(chunk) for chunk in compressed)),
+            mb / (middle - start), mb / (end - middle)))
+
+
+BENCHMARKS = {'chunking': bench_chunking, 'fsync': bench_fsync,
+              'compression': bench_compression}
+
+
+def main(argv):
+    if not argv or argv[0] not in BENCHMARKS:
+        print(__doc__)
+        sys.exit(2)
+
+    BENCHMARKS[argv[0]](argv[1:])
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -14,12 +14,16 @@ ZOO_IP = 'localhost'
 
 def main(argv):
 
+    # --durable acknowledges writes only once they are fsynced (see zchunkserver.GroupCommit)
+    durable = '--durable' in argv
+    argv = [arg for arg in argv if arg != '--durable']
+
     if argv:
         zoo_ip = str(argv[0])
     else:
         zoo_ip = ZOO_IP
 
-    chunkserver = zchunkserver.ZChunkserver(zoo_ip=zoo_ip)
+    chunkserver = zchunkserver.ZChunkserver(zoo_ip=zoo_ip, durable=durable)
     reg_num = int(chunkserver.chunkloc)
     # reg_num = 0
     s = zerorpc.Server(chunkserver)
@@ -1,23 +1,414 @@
 import ast
+import collections
+import functools
 import os
-import re
-import subprocess
+import queue
+import threading
+import time
 import xxhash
 import getpass
 import traceback
 
+import gevent
+import gevent.event
+import msgpack
 import zerorpc
 from kazoo.client import KazooClient, KazooState
 from kazoo.exceptions import NoNodeError
 
 import zutils
 
+CHUNKSERVER_PATH = 'chunkserver/'
+
+CHECKSUM_BLOCK_SIZE = 64 * 1024  # bytes of chunk covered by each checksum in its sidecar file
+CHECKSUM_SIZE = 8  # bytes of an xxh64 digest
+SCRUB_RATE = 10  # MB/s of stored chunks the scrubber verifies, 0 disables it
+SCRUB_INTERVAL = 3600  # seconds between scrub passes
+SCRUB_PIECE = 16 * CHECKSUM_BLOCK_SIZE  # bytes the scrubber reads at a time
+SCRUB_BACKOFF = 0.01  # seconds background work pauses per client request in flight
+SCRUB_MAX_BACKOFF = 0.5  # longest such pause, so background work goes on under any load
+STATS_INTERVAL = 2  # seconds between samples of network, disk and storage use
+RATE_STATS = ('net_rx', 'net_tx', 'disk_read', 'disk_write', 'read_iops', 'write_iops',
+              'disk_queue')
+SECTOR_SIZE = 512  # unit of the sector counts in /proc/diskstats
+SHARD_DIGITS = 2  # hex digits of a chunkuuid's hash naming its subdirectory, 16 ** 2 of them
+INDEX_SLACK = 10000  # superseded index records tolerated before the log is compacted
+INDEX_COMPACT_INTERVAL = 60  # seconds between checks for an index log to compact
+PACK_THRESHOLD = 64 * 1024  # chunks up to this many bytes go into pack files, 0 disables packing
+PACK_SIZE = 64 * 1024 * 1024  # bytes appended to a pack file before starting the next one
+PACK_GARBAGE = 0.5  # fraction of deleted bytes at which a pack file is compacted
+PACK_COMPACT_INTERVAL = 600  # seconds between checks for pack files to compact
+PACK_GRACE = 1  # seconds a compacted pack file is kept for reads that already located it
+GROUP_COMMIT_INTERVAL = 0  # seconds durable writes wait to be fsynced together
+CHUNK_CACHE_SIZE = 128 * 1024 * 1024  # bytes of hot chunks kept in memory, 0 disables the cache
+CHECKSUM_CACHE_SIZE = 16 * 1024 * 1024  # bytes of recently used checksum tables kept in memory
+
+
+class ChecksumError(IOError):
+    """ Stored chunk contents do not match their checksums """
+
+
+class ChunkIndex:
+    """ Metadata of the chunks stored on a chunkserver:
+    chunkuuid -> (size, digest, version, pack, offset), where version counts the writes of
+    the chunk and pack, offset locate chunks kept in a pack file (both None for chunks in
+    their own file).  Kept in memory and persisted as an append-only log of msgpack records,
+    so a restart needs no directory scan. """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()  # the scrubber and compaction threads update it too
+        self.entries = {}
+        self.hints = {}  # chunkuuid -> name of the file the chunk was created for
+        self.pack_live = {}  # pack number -> bytes of indexed chunks in it
+        self.records = self._replay()  # records in the log, superseded ones included
+        self.pending = None  # records logged while compact rewrites the log
+        if self._compact_due():
+            self._install(self._compacted(self.entries, self.hints), self.records)
+        self.log = open(path, 'ab')
+
+    def _replay(self):
+        """ Loads the log, dropping a record torn by a crash.  Returns the number of records """
+        records = 0
+        try:
+            f = open(self.path, 'r+b')
+        except FileNotFoundError:
+            return records
+
+        with f:
+            unpacker = msgpack.Unpacker(f, raw=False)
+            end = 0
+            for record in unpacker:
+                self._apply(record)
+                records += 1
+                end = unpacker.tell()
+            f.truncate(end)
+        return records
+
+    def _compact_due(self):
+        return self.records > 2 * (len(self.entries) + len(self.hints)) + INDEX_SLACK
+
+    def _compacted(self, entries, hints):
+        """ Writes a log with one record per stored chunk and hint next to the index log and
+        fsyncs it, durable mode or not.  Returns its path. """
+        path = self.path + '.tmp'
+        with open(path, 'wb') as f:
+            for chunkuuid, entry in entries.items():
+                f.write(msgpack.packb(['put', chunkuuid] + list(entry), use_bin_type=True))
+            for chunkuuid, filename in hints.items():
+                f.write(msgpack.packb(['hint', chunkuuid, filename], use_bin_type=True))
+            f.flush()
+            os.fsync(f.fileno())
+        return path
+
+    def _install(self, path, records):
+        """ Replaces the index log with a compacted one of records records """
+        os.replace(path, self.path)
+        GroupCommit.fsync(os.path.dirname(self.path) or '.')
+        self.records = records
+
+    def compact(self):
+        """
+        Rewrites the log with one record per stored chunk and hint once superseded records
+        pile up, so it stays proportional to the chunks stored.  Run by the index thread: the
+        rewrite works on a copy of the tables without the lock, and records logged meanwhile
+        are added to the new log before it replaces the old one.
+        :return: whether the log was compacted
+        """
+        with self.lock:
+            if not self._compact_due() or self.pending is not None:
+                return False
+            entries, hints = dict(self.entries), dict(self.hints)
+            self.pending = []
+        try:
+            path = self._compacted(entries, hints)
+        except Exception:
+            with self.lock:
+                self.pending = None
+            raise
+
+        with self.lock:
+            pending, self.pending = self.pending, None
+            with open(path, 'ab') as f:
+                for record in pending:
+                    f.write(msgpack.packb(record, use_bin_type=True))
+                f.flush()
+                os.fsync(f.fileno())
+            self.log.close()
+            self._install(path, len(entries) + len(hints) + len(pending))
+            self.log = open(self.path, 'ab')
+        return True
+
+    def _apply(self, record):
+        """ Applies a put, del or hint record to the entries, returns the entry it replaced """
+        chunkuuid = record[1]
+        if record[0] == 'hint':
+            self.hints[chunkuuid] = record[2]
+            return self.entries.get(chunkuuid)
+
+        old = self.entries.pop(chunkuuid, None)
+        self._account(old, -1)
+        if record[0] == 'put':
+            # records from before pack files have no location
+            entry = (tuple(record[2:]) + (None, None))[:5]
+            self.entries[chunkuuid] = entry
+            self._account(entry, 1)
+        else:
+            self.hints.pop(chunkuuid, None)
+        return old
+
+    def _account(self, entry, sign):
+        if entry is not None and entry[3] is not None:
+            live = self.pack_live.get(entry[3], 0) + sign * entry[0]
+            if live:
+                self.pack_live[entry[3]] = live
+            else:
+                self.pack_live.pop(entry[3], None)
+
+    def _log(self, record):
+        """ Applies and persists a record, the caller holds the lock.  The log is compacted by
+        the index thread, see compact. """
+        old = self._apply(record)
+        self.log.write(msgpack.packb(record, use_bin_type=True))
+        self.log.flush()
+        self.records += 1
+        if self.pending is not None:
+            self.pending.append(record)
+        return old
+
+    def put(self, chunkuuid, size, digest, pack=None, offset=None):
+        """ Records a write of chunkuuid, returns the entry it replaced """
+        with self.lock:
+            version = self.entries.get(chunkuuid, (0, None, 0))[2] + 1
+            return self._log(['put', chunkuuid, size, digest, version, pack, offset])
+
+    def remove(self, chunkuuid, entry=None):
+        """ Returns the entry of chunkuuid, None if it was not indexed.  If entry is given,
+        the chunk is only removed if it did not change since entry was read. """
+        with self.lock:
+            if chunkuuid not in self.entries or entry not in (None, self.entries[chunkuuid]):
+                return None
+            return self._log(['del', chunkuuid])
+
+    def relocate(self, chunkuuid, entry, pack, offset):
+        """ Moves a packed chunk to a new location unless it changed since entry was read.
+        Returns whether it was moved. """
+        with self.lock:
+            if self.entries.get(chunkuuid) != entry:
+                return False
+            self._log(['put', chunkuuid] + list(entry[:3]) + [pack, offset])
+            return True
+
+    def set_hint(self, chunkuuid, filename):
+        """ Records the file a chunk was created for, reported by populate so a master
+        without metadata can rebuild its namespace """
+        with self.lock:
+            if self.hints.get(chunkuuid) != filename:
+                self._log(['hint', chunkuuid, filename])
+
+    def hint(self, chunkuuid):
+        return self.hints.get(chunkuuid)
+
+    def packed_in(self, pack):
+        """ Returns [(chunkuuid, entry)] of the chunks stored in a pack file """
+        with self.lock:
+            return [(chunkuuid, entry) for chunkuuid, entry in self.entries.items()
+                    if entry[3] == pack]
+
+    def get(self, chunkuuid):
+        return self.entries.get(chunkuuid)
+
+    def __contains__(self, chunkuuid):
+        return chunkuuid in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(list(self.entries))
+
+    def close(self):
+        self.log.close()
+
+
+class PackStore:
+    """ Pack files holding small chunks back to back, so they cost no inode of their own.
+    Chunks are only ever appended; space of deleted chunks is reclaimed by copying the live
+    ones of a pack file into the current one and removing it. """
+
+    def __init__(self, root, pack_size=PACK_SIZE):
+        self.root = root
+        self.pack_size = pack_size
+        self.lock = threading.Lock()  # appends come from the compaction thread too
+        self.fds = {}  # pack number -> open file descriptor
+        os.makedirs(root, exist_ok=True)
+        packs = [int(name[len('pack-'):]) for name in os.listdir(root) if name.startswith('pack-')]
+        self.current = max(packs) if packs else 0
+        self.size = os.fstat(self._fd(self.current, create=True)).st_size
+
+    def pack_filename(self, pack):
+        return os.path.join(self.root, 'pack-%06d' % pack)
+
+    def _fd(self, pack, create=False):
+        """ Returns an open descriptor of a pack file.  Only the pack appended to is created,
+        a read from a stale index entry raises FileNotFoundError instead of bringing back an
+        empty pack that was removed. """
+        fd = self.fds.get(pack)
+        if fd is None:
+            flags = os.O_RDWR | os.O_CREAT if create else os.O_RDWR
+            fd = self.fds[pack] = os.open(self.pack_filename(pack), flags, 0o644)
+        return fd
+
+    def append(self, data):
+        """ Returns (pack, offset) data was written at """
+        with self.lock:
+            if self.size and self.size + len(data) > self.pack_size:
+                self.current += 1
+                self.size = 0
+            offset = self.size
+            os.pwrite(self._fd(self.current, create=True), data, offset)
+            self.size += len(data)
+            return self.current, offset
+
+    def read(self, pack, offset, size):
+        with self.lock:
+            fd = self._fd(pack)
+        data = os.pread(fd, size, offset)
+        if len(data) != size:
+            raise ChecksumError("pack %d is truncated at %d" % (pack, offset))
+        return data
+
+    def sizes(self):
+        """ Returns {pack: bytes} of the pack files that are no longer appended to """
+        with self.lock:
+            return {int(name[len('pack-'):]): os.path.getsize(os.path.join(self.root, name))
+                    for name in os.listdir(self.root)
+                    if name.startswith('pack-') and int(name[len('pack-'):]) != self.current}
+
+    def remove(self, pack):
+        with self.lock:
+            fd = self.fds.pop(pack, None)
+            if fd is not None:
+                os.close(fd)
+            os.remove(self.pack_filename(pack))
+
+
+class ChunkCache:
+    """ LRU cache of whole chunks that passed verification, bounded by their total size.
+    Chunks bigger than a quarter of the budget are not kept, so one large chunk cannot push
+    out the hot set.  Also holds the checksum tables of chunks, in a cache of its own. """
+
+    def __init__(self, budget=CHUNK_CACHE_SIZE):
+        self.budget = budget
+        self.lock = threading.Lock()  # the scrubber thread invalidates too
+        self.entries = collections.OrderedDict()  # chunkuuid -> contents
+        self.size = 0  # bytes of contents cached
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, chunkuuid):
+        """ Returns the cached contents of chunkuuid, None if it is not cached """
+        with self.lock:
+            data = self.entries.get(chunkuuid)
+            if data is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(chunkuuid)
+            self.hits += 1
+            return data
+
+    def put(self, chunkuuid, data):
+        if not self.budget or len(data) * 4 > self.budget:
+            return
+        with self.lock:
+            old = self.entries.pop(chunkuuid, None)
+            if old is not None:
+                self.size -= len(old)
+            self.entries[chunkuuid] = data
+            self.size += len(data)
+            while self.size > self.budget:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def invalidate(self, chunkuuid):
+        with self.lock:
+            data = self.entries.pop(chunkuuid, None)
+            if data is not None:
+                self.size -= len(data)
+
+
+class GroupCommit:
+    """ Makes written files durable in batches.  Writers queue the files they wrote and
+    wait; interval after the first of them a flush fsyncs the files of all waiting writers
+    at once, on the hub's threadpool so the event loop keeps serving requests meanwhile.
+    Concurrent fsyncs let the filesystem merge them into few journal commits. """
+
+    def __init__(self, interval=GROUP_COMMIT_INTERVAL):
+        self.interval = interval
+        self.pending = set()  # paths to fsync in the next flush
+        self.result = gevent.event.AsyncResult()  # set when the next flush is done
+        self.flusher = None
+
+    def sync(self, paths):
+        """ Blocks the calling greenlet until paths (files or directories) are durable """
+        self.pending.update(paths)
+        result = self.result
+        if self.flusher is None:
+            self.flusher = gevent.spawn_later(self.interval, self._flush)
+        result.get()
+
+    def _flush(self):
+        """ Flushes batches until no writer waits.  Writers arriving during a flush form the
+        next batch, so batches grow as fsyncs get slower. """
+        threadpool = gevent.get_hub().threadpool
+        while self.pending:
+            paths, self.pending = self.pending, set()
+            result, self.result = self.result, gevent.event.AsyncResult()
+
+            jobs = [threadpool.spawn(self.fsync, path) for path in paths]
+            gevent.joinall(jobs)
+            failed = [job for job in jobs if not job.successful()]
+            if failed:
+                result.set_exception(failed[0].exception)
+            else:
+                result.set(len(paths))
+        self.flusher = None
+
+    @staticmethod
+    def fsync(path):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def foreground(method):
+    """ Counts running calls of method as foreground load, see _yield_to_foreground """
+
+    @functools.wraps(method)
+    def counted(self, *args, **kwargs):
+        self.inflight += 1
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.inflight -= 1
+    return counted
+
 
 class ZChunkserver:
-    def __init__(self, zoo_ip='localhost:2181'):
-        self.chunktable = {}
+    def __init__(self, zoo_ip='localhost:2181', scrub_rate=SCRUB_RATE,
+                 scrub_interval=SCRUB_INTERVAL, pack_threshold=PACK_THRESHOLD, durable=False,
+                 commit_interval=GROUP_COMMIT_INTERVAL, cache_size=CHUNK_CACHE_SIZE):
+        # chunkuuid -> whole chunk digest followed by per-block digests, for recently used chunks
+        self.checksums = ChunkCache(CHECKSUM_CACHE_SIZE)
+        self.cache = ChunkCache(cache_size)  # hot chunks, served without touching the disk
+        self.inflight = 0  # client reads and writes in progress
+        self.stats = {}  # latest sample, see get_stats
         self.chunkloc = None
         self.master = zerorpc.Client()
+        # other chunkservers, for forwarding and copying chunks
+        self.peers = zutils.ConnectionPool(directory=lambda: self.master.get('chunkservers'))
         self.zookeeper = KazooClient(zoo_ip)
 
         # register with zookeeper, get IP of master
@@ -34,12 +425,56 @@ class ZChunkserver:
             # print(e.__doc__, e.message)
             traceback.print_exc()
 
+        zutils.watch_chunkservers(self.zookeeper, self.peers, CHUNKSERVER_PATH)
 
         # local directory where chunks are stored
         self.local_filesystem_root = "/tmp/gfs/chunks/" #+ repr(int(self.chunkloc))
         if not os.access(self.local_filesystem_root, os.W_OK):
             os.makedirs(self.local_filesystem_root)
 
+        # chunks live in hashed subdirectories and are listed in an index log
+        for shard in range(16 ** SHARD_DIGITS):
+            os.makedirs(os.path.join(self.local_filesystem_root, '%0*x' % (SHARD_DIGITS, shard)),
+                        exist_ok=True)
+        index_filename = os.path.join(self.local_filesystem_root, 'index.log')
+        flat_layout = not os.path.exists(index_filename)
+        self.chunktable = ChunkIndex(index_filename)
+        if flat_layout:
+            self._migrate_flat_layout()
+
+        # small chunks are appended to pack files instead.  A packed chunk keeps a single
+        # checksum, so it must fit in one checksum block.
+        self.pack_threshold = min(pack_threshold, CHECKSUM_BLOCK_SIZE)
+        if self.pack_threshold < pack_threshold:
+            print("Packing chunks of up to %d bytes, one checksum block" % self.pack_threshold)
+        self.packs = PackStore(os.path.join(self.local_filesystem_root, 'packs'))
+        compactor = threading.Thread(target=self._compact_packs_forever, daemon=True)
+        compactor.start()
+        index_compactor = threading.Thread(target=self._compact_index_forever, daemon=True)
+        index_compactor.start()
+
+        # in durable mode writes are acknowledged once fsynced, in groups
+        self.group_commit = GroupCommit(commit_interval) if durable else None
+
+        # deleted chunks are moved to the trash directory and unlinked in the background
+        self.trash_root = os.path.join(self.local_filesystem_root, '.trash')
+        os.makedirs(self.trash_root, exist_ok=True)
+        self.unlink_queue = queue.Queue()
+        for name in os.listdir(self.trash_root):  # left over from before a restart
+            self.unlink_queue.put(os.path.join(self.trash_root, name))
+        unlinker = threading.Thread(target=self._unlink_forever, daemon=True)
+        unlinker.start()
+
+        counters = self._sample_stats(None)
+        sampler = threading.Thread(target=self._sample_stats_forever, args=(counters,),
+                                   daemon=True)
+        sampler.start()
+
+        if scrub_rate:
+            scrubber = threading.Thread(target=self._scrub_forever,
+                                        args=(scrub_rate, scrub_interval), daemon=True)
+            scrubber.start()
+
     def _register_with_zookeeper(self):
 
         def my_listener(state):
@@ -75,12 +510,11 @@ class ZChunkserver:
         print('I am chunkserver #' + str(int(self.chunkloc)))
         self.master.answer_server(int(self.chunkloc))
 
+    @foreground
     def write(self, chunkuuid, chunk, forward=None):
-        local_filename = self.chunk_filename(chunkuuid)
         try:
-            with open(local_filename, "wb") as f:
-                f.write(chunk)
-                self.chunktable[chunkuuid] = local_filename
+            digest = self._store(chunkuuid, chunk)
+            self._make_durable(chunkuuid)
         except:
             return False
 
@@ -88,87 +522,750 @@ class ZChunkserver:
         if forward:
             print("Forwarding chunk to loc", forward)
             self.send_chunk(chunkuuid, str([forward]), chunk)
-        return xxhash.xxh64(chunk).digest()
+        return digest
 
     def close(self):
+        self.peers.close()
+        self.chunktable.close()
         self.master.close()
 
-    @staticmethod
-    def get_stats():
+    def get_stats(self):
+        """
+        Returns the latest load sample without blocking:
+        {'time': when sampled, 'net_rx', 'net_tx', 'disk_read', 'disk_write': bytes/s,
+         'read_iops', 'write_iops', 'disk_queue': average requests queued at the disk,
+         'requests': client requests in progress, 'free_bytes', 'total_bytes', 'chunks',
+         'cache_hits', 'cache_misses': chunk cache lookups since start, 'cache_bytes'}
+        Rates are None until two samples are taken; disk figures stay None if the chunk
+        directory is on a device without /proc/diskstats entry (tmpfs, overlay).
+        """
+        stats = dict(self.stats)
+        stats['requests'] = self.inflight
+        stats['cache_hits'] = self.cache.hits
+        stats['cache_misses'] = self.cache.misses
+        stats['cache_bytes'] = self.cache.size
+        return stats
+
+    def _sample_stats_forever(self, counters):
+        """ Stats sampler thread """
+        while True:
+            time.sleep(STATS_INTERVAL)
+            try:
+                counters = self._sample_stats(counters)
+            except Exception as e:
+                self.print_exception('sampling stats', e)
 
-        results = []
-        pattern = r' \d+[\.]?\d*'
-        first = ['ifstat', '-q', '-i', 'enP0s3', '-S', '0.2', '1']  # get network traffic
-        second = ['df', '/']  # get free space
-        p1 = subprocess.Popen(first, stdout=subprocess.PIPE)
-        p2 = subprocess.Popen(second, stdout=subprocess.PIPE)
+    def _sample_stats(self, previous):
+        """
+        Takes a stats sample, computing rates from the counters of the previous one
+        :return: counters to pass to the next call
+        """
+        counters = self._stat_counters()
+        vfs = os.statvfs(self.local_filesystem_root)
+        stats = dict.fromkeys(RATE_STATS)
+        stats.update({'time': counters[0],
+                      'free_bytes': vfs.f_bavail * vfs.f_frsize,
+                      'total_bytes': vfs.f_blocks * vfs.f_frsize,
+                      'chunks': len(self.chunktable)})
 
-        # get transfer speed and parse results
-        transfer_speed = p1.communicate()[0]
-        transfer_speed = re.findall(pattern, transfer_speed)
-        results.append(sum([float(num) for num in transfer_speed]))
+        if previous is not None:
+            now, rx, tx, disk = counters
+            then, rx0, tx0, disk0 = previous
+            elapsed = max(now - then, 1e-6)
+            if rx is not None and rx0 is not None:
+                stats['net_rx'] = (rx - rx0) / elapsed
+                stats['net_tx'] = (tx - tx0) / elapsed
+            if disk is not None and disk0 is not None:
+                delta = [new - old for new, old in zip(disk, disk0)]
+                stats['read_iops'] = delta[0] / elapsed
+                stats['disk_read'] = delta[2] * SECTOR_SIZE / elapsed
+                stats['write_iops'] = delta[4] / elapsed
+                stats['disk_write'] = delta[6] * SECTOR_SIZE / elapsed
+                stats['disk_queue'] = delta[10] / 1000. / elapsed  # weighted ms doing I/O
 
-        # get storage info and parse results
-        storage = p2.communicate()[0]
-        storage = re.findall(r'\d+%', storage)  # find entry with %
-        results.append(int(storage[0][:-1]))  # append entry without %
+        self.stats = stats
+        return counters
 
-        return results
+    def _stat_counters(self):
+        """
+        Reads the cumulative counters rates are computed from
+        :return: (time, network bytes received, network bytes sent, /proc/diskstats fields
+                  of the chunk directory's device), None for counters that are unavailable
+        """
+        now = time.time()
+        rx = tx = disk = None
+        try:
+            rx = tx = 0
+            with open('/proc/net/dev') as f:
+                for line in f.readlines()[2:]:  # two header lines
+                    interface, fields = line.split(':', 1)
+                    if interface.strip() != 'lo':
+                        fields = fields.split()
+                        rx += int(fields[0])
+                        tx += int(fields[8])
+        except (IOError, OSError):
+            rx = tx = None
+
+        try:
+            device = os.stat(self.local_filesystem_root).st_dev
+            with open('/proc/diskstats') as f:
+                for line in f:
+                    fields = line.split()
+                    if (int(fields[0]), int(fields[1])) == (os.major(device), os.minor(device)):
+                        disk = [int(field) for field in fields[3:14]]
+                        break
+        except (IOError, OSError):
+            pass
+
+        return now, rx, tx, disk
 
     ##############################################################################
 
-    def rwrite(self, chunkuuid, chunk):
-        local_filename = self.chunk_filename(chunkuuid)
+    @foreground
+    def rwrite(self, chunkuuid, chunk, filename=None):
         try:
-            with open(local_filename, "wb") as f:
-                f.write(chunk)
-            self.chunktable[chunkuuid] = local_filename
+            self._store(chunkuuid, chunk)
+            if filename:
+                self.chunktable.set_hint(chunkuuid, filename)
+            self._make_durable(chunkuuid)
             return True
         except:
             return False
 
-    def read(self, chunkuuid):
-        data = None
-        local_filename = self.chunk_filename(chunkuuid)
-        with open(local_filename, "rb") as f:
-            data = f.read()
-        return data
+    def _store(self, chunkuuid, chunk):
+        """
+        Writes a chunk followed by its checksum sidecar file, or appends it to a pack file
+        if it is small
+        :return: xxhash digest of the whole chunk
+        """
+        if len(chunk) <= self.pack_threshold:
+            return self._store_packed(chunkuuid, memoryview(chunk))
+
+        self.cache.invalidate(chunkuuid)
+        with open(self.chunk_filename(chunkuuid), "wb") as f:
+            f.write(chunk)
+
+        view = memoryview(chunk)
+        blocks = (view[start:start + CHECKSUM_BLOCK_SIZE]
+                  for start in range(0, len(view), CHECKSUM_BLOCK_SIZE))
+        digest = self._write_checksums(chunkuuid, blocks)[:CHECKSUM_SIZE]
+        self.chunktable.put(chunkuuid, len(view), digest)
+        return digest
+
+    def _store_packed(self, chunkuuid, data):
+        """ Appends a small chunk to the current pack file, returns its digest.  A packed
+        chunk is a single checksum block, so its digest is also its only block checksum. """
+        digest = xxhash.xxh64(data).digest()
+        self.cache.invalidate(chunkuuid)
+        pack, offset = self.packs.append(data)
+        self.checksums.invalidate(chunkuuid)  # the index entry has them now
+        old = self.chunktable.put(chunkuuid, len(data), digest, pack, offset)
+        if old is not None and old[3] is None:
+            # the chunk used to be bigger and had its own file
+            for filename in (self.chunk_filename(chunkuuid), self.checksum_filename(chunkuuid)):
+                try:
+                    self._trash(filename)
+                except FileNotFoundError:
+                    pass
+        return digest
+
+    def _make_durable(self, chunkuuid):
+        """ In durable mode, waits for the group commit that fsyncs a stored chunk: its data,
+        checksums, directory entries and index record """
+        if self.group_commit is None:
+            return
+
+        entry = self._packed(chunkuuid)
+        if entry is not None:
+            paths = [self.packs.pack_filename(entry[3]), self.packs.root]
+        else:
+            paths = [self.chunk_filename(chunkuuid), self.checksum_filename(chunkuuid),
+                     os.path.dirname(self.chunk_filename(chunkuuid))]
+        self.group_commit.sync(paths + [self.chunktable.path])
+
+    def _packed(self, chunkuuid):
+        """ Returns the index entry of chunkuuid if it is stored in a pack file, else None """
+        entry = self.chunktable.get(chunkuuid)
+        return entry if entry is not None and entry[3] is not None else None
+
+    @foreground
+    def write_segment(self, chunkuuid, offset, segment, chain=()):
+        """
+        Stores a segment of a chunk being written and passes it down the replication chain.
+        The segment is handed to the next replica before the local disk write, so each
+        replica forwards while it writes and segments flow through the chain in a pipeline.
+        The chunk only becomes readable on commit.
+        :param chain: chunklocs of the replicas after this one, in order
+        :return: chunklocs that have stored the segment, this one first; the list ends
+                 early if a replica down the chain failed
+        """
+        forward = gevent.spawn(self._forward, 'write_segment', chain, chunkuuid, offset,
+                               segment) if chain else None
+        gevent.sleep(0)  # let the forward reach the socket before blocking on disk
+
+        fd = os.open(self.part_filename(chunkuuid), os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            os.pwrite(fd, segment, offset)
+        finally:
+            os.close(fd)
+
+        return [self.chunkloc] + (forward.get() if forward else [])
+
+    @foreground
+    def commit(self, chunkuuid, size, digest, filename, chain=()):
+        """
+        Completes a chunk sent with write_segment on this replica and down the chain, each
+        replica committing in parallel.  A replica verifies the chunk against digest before
+        making it readable.
+        :param filename: file the chunk is written for, kept as a hint for populate
+        :return: chunklocs that committed the chunk, this one first; empty if this replica
+                 failed, shorter than the chain if one down the chain did
+        """
+        forward = gevent.spawn(self._forward, 'commit', chain, chunkuuid, size,
+                               digest, filename) if chain else None
+
+        part_filename = self.part_filename(chunkuuid)
+        committed = []
+        try:
+            fd = os.open(part_filename, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                os.ftruncate(fd, size)
+                data = self._pread(fd, 0, size)
+            finally:
+                os.close(fd)
+
+            view = memoryview(data)
+            checksums = self._checksum_blocks(view[start:start + CHECKSUM_BLOCK_SIZE]
+                                              for start in range(0, size, CHECKSUM_BLOCK_SIZE))
+            if checksums[:CHECKSUM_SIZE] != digest:
+                raise ChecksumError("chunk %s does not match its digest" % chunkuuid)
 
-    def _establish_connection(self, chunkloc):
-        chunkservers = self.master.get('chunkservers')
-        zclient = zerorpc.Client()
-        print('Server connecting to chunkserver at %s' % chunkloc)
-        zclient.connect(chunkservers[chunkloc])
-        #zclient.print_name()
-        return zclient
+            if size <= self.pack_threshold:
+                self._store_packed(chunkuuid, view)
+                os.remove(part_filename)
+            else:
+                self.cache.invalidate(chunkuuid)
+                os.replace(part_filename, self.chunk_filename(chunkuuid))
+                self._save_checksums(chunkuuid, checksums)
+                self.chunktable.put(chunkuuid, size, digest)
+            self.chunktable.set_hint(chunkuuid, filename)
+            self._make_durable(chunkuuid)
+            committed = [self.chunkloc]
+        except (IOError, OSError) as e:
+            print("Failed committing %s: %s" % (chunkuuid, e.strerror or e))
+            if os.path.exists(part_filename):
+                os.remove(part_filename)
+
+        downstream = forward.get() if forward else []
+        return committed + downstream if committed else []
+
+    @foreground
+    def commit_append(self, chunkuuid, offset, size, digest, filename, compression=None,
+                      chain=()):
+        """
+        Extends a stored chunk of offset bytes to size bytes with the bytes sent for
+        [offset, size) with write_segment, on this replica and down the chain.  Only the new
+        bytes cross the network; each replica joins them to its own copy of the chunk.
+        :param digest: digest of the new bytes
+        :param compression: compression of the file; the chunk is decompressed, extended
+                            and compressed again
+        :return: chunklocs that extended the chunk, this one first unless it failed
+        """
+        forward = gevent.spawn(self._forward, 'commit_append', chain, chunkuuid, offset, size,
+                               digest, filename, compression) if chain else None
+
+        part_filename = self.part_filename(chunkuuid)
+        committed = []
+        try:
+            fd = os.open(part_filename, os.O_RDONLY)
+            try:
+                tail = self._pread(fd, offset, size - offset)
+            finally:
+                os.close(fd)
+                os.remove(part_filename)
+            if xxhash.xxh64(tail).digest() != digest:
+                raise ChecksumError("appended bytes of %s do not match their digest" % chunkuuid)
+
+            data = self.read(chunkuuid)
+            if compression:
+                data = zutils.decompress(data, compression)
+            if len(data) != offset:
+                raise IOError("chunk %s is %d bytes long, not %d" % (chunkuuid, len(data), offset))
+            data = bytes(data) + tail
+            if compression:
+                data = zutils.compress(data, compression)
+            self._store(chunkuuid, data)
+            self.chunktable.set_hint(chunkuuid, filename)
+            self._make_durable(chunkuuid)
+            committed = [self.chunkloc]
+        except Exception as e:
+            print("Failed appending to %s: %s" % (chunkuuid, getattr(e, 'strerror', None) or e))
+
+        # replicas down the chain may have appended even if this one failed
+        return committed + (forward.get() if forward else [])
+
+    def _forward(self, method, chain, *args):
+        """
+        Calls method on the next replica in chain, passing it the rest of the chain
+        :return: the replica's answer, an empty list if it failed
+        """
+        try:
+            return getattr(self.peers[chain[0]], method)(*args + (chain[1:],))
+        except Exception as e:
+            print("Failed forwarding %s to loc %s: %s" % (method, chain[0], type(e).__name__))
+            return []
+
+    def _write_checksums(self, chunkuuid, blocks):
+        """
+        Hashes a chunk block by block and saves the checksums next to it
+        :param blocks: the chunk's contents in CHECKSUM_BLOCK_SIZE pieces
+        :return: whole chunk digest followed by the per-block digests
+        """
+        checksums = self._checksum_blocks(blocks)
+        self._save_checksums(chunkuuid, checksums)
+        return checksums
+
+    @staticmethod
+    def _checksum_blocks(blocks):
+        """ Returns the whole chunk digest followed by the digest of each block """
+        whole = xxhash.xxh64()
+        block_digests = []
+        for block in blocks:
+            whole.update(block)
+            block_digests.append(xxhash.xxh64(block).digest())
+        return whole.digest() + b''.join(block_digests)
+
+    def _save_checksums(self, chunkuuid, checksums):
+        """ Writes a chunk's checksum sidecar, atomically so readers never see a partial
+        table """
+        checksum_filename = self.checksum_filename(chunkuuid)
+        with open(checksum_filename + '.tmp', "wb") as f:
+            f.write(checksums)
+        os.replace(checksum_filename + '.tmp', checksum_filename)
+        self.checksums.put(chunkuuid, checksums)
+        return checksums
+
+    def _load_checksums(self, chunkuuid, cache=True):
+        """
+        Returns the whole chunk digest followed by the per-block digests.  Chunks stored
+        before checksums existed are hashed once and get their sidecar written then.
+        :param cache: whether to keep the table for later reads; the scrubber, which visits
+                      every chunk once, does not
+        """
+        checksums = self.checksums.get(chunkuuid)
+        if checksums is not None:
+            return checksums
+
+        entry = self._packed(chunkuuid)
+        if entry is not None:
+            return entry[1] + entry[1] if entry[0] else entry[1]
+
+        try:
+            with open(self.checksum_filename(chunkuuid), "rb") as f:
+                checksums = f.read()
+        except FileNotFoundError:
+            with open(self.chunk_filename(chunkuuid), "rb") as f:
+                return self._write_checksums(chunkuuid,
+                                             iter(lambda: f.read(CHECKSUM_BLOCK_SIZE), b''))
+
+        if cache:
+            self.checksums.put(chunkuuid, checksums)
+        return checksums
+
+    def _verify(self, chunkuuid, data, first_block, checksums=None):
+        """
+        Checks block-aligned chunk data starting at block first_block against the stored
+        checksums, raising ChecksumError on a mismatch
+        :param checksums: the chunk's checksum table if the caller has it, else it is loaded
+        """
+        if checksums is None:
+            checksums = self._load_checksums(chunkuuid)
+        view = memoryview(data)
+        for block, start in enumerate(range(0, len(view), CHECKSUM_BLOCK_SIZE), first_block):
+            expected = checksums[(block + 1) * CHECKSUM_SIZE:(block + 2) * CHECKSUM_SIZE]
+            if xxhash.xxh64(view[start:start + CHECKSUM_BLOCK_SIZE]).digest() != expected:
+                print("Checksum mismatch in chunk %s block %d" % (chunkuuid, block))
+                raise ChecksumError("chunk %s is corrupt at block %d" % (chunkuuid, block))
+
+    @foreground
+    def read(self, chunkuuid, offset=0, length=None):
+        """
+        Returns length bytes of the chunk starting at offset, the rest of the chunk if length
+        is None.  Uses positional reads, so only the checksum blocks overlapping the range are
+        read from disk and verified; raises ChecksumError if one of them is corrupt.
+        Chunks read whole are cached, and cached chunks are served from memory.
+        """
+        data = self.cache.get(chunkuuid)
+        if data is not None:
+            return self._slice(data, offset, length)
+
+        entry = self._packed(chunkuuid)
+        if entry is not None:
+            data = self.packs.read(entry[3], entry[4], entry[0])
+            self._verify(chunkuuid, data, 0)
+            self.cache.put(chunkuuid, data)
+            return self._slice(data, offset, length)
+
+        fd = os.open(self.chunk_filename(chunkuuid), os.O_RDONLY)
+        try:
+            size = os.fstat(fd).st_size
+            end = size if length is None else min(offset + length, size)
+            if end <= offset:
+                return b''
+            first = offset // CHECKSUM_BLOCK_SIZE
+            block_end = min(-(-end // CHECKSUM_BLOCK_SIZE) * CHECKSUM_BLOCK_SIZE, size)
+            data = self._pread(fd, first * CHECKSUM_BLOCK_SIZE,
+                               block_end - first * CHECKSUM_BLOCK_SIZE)
+        finally:
+            os.close(fd)
+
+        self._verify(chunkuuid, data, first)
+        if len(data) == size:
+            self.cache.put(chunkuuid, data)
+        start = offset - first * CHECKSUM_BLOCK_SIZE
+        return data[start:start + end - offset]
+
+    @staticmethod
+    def _slice(data, offset, length):
+        """ Returns length bytes of data from offset, the rest of it if length is None """
+        if offset == 0 and (length is None or length >= len(data)):
+            return data
+        end = len(data) if length is None else min(offset + length, len(data))
+        return data[offset:end] if end > offset else b''
+
+    def read_many(self, requests):
+        """
+        Reads several chunk slices in one call, e.g. small records spread over chunks
+        :param requests: list of (chunkuuid, offset, length), length None for the rest of the chunk
+        :return: list of the slices in request order, None for slices that could not be read
+        """
+        slices = []
+        for chunkuuid, offset, length in requests:
+            try:
+                slices.append(self.read(chunkuuid, offset, length))
+            except (IOError, OSError) as e:
+                print("Failed reading %s: %s" % (chunkuuid, e.strerror or e))
+                slices.append(None)
+        return slices
+
+    @staticmethod
+    def _pread(fd, offset, length):
+        """ Reads up to length bytes at offset, fewer only at end of file """
+        data = os.pread(fd, length, offset)
+        if len(data) == length or not data:
+            return data
+
+        parts = [data]
+        received = len(data)
+        while received < length:
+            data = os.pread(fd, length - received, offset + received)
+            if not data:
+                break
+            parts.append(data)
+            received += len(data)
+        return b''.join(parts)
+
+    def _scrub_forever(self, rate, interval):
+        """ Scrubber thread: verifies all chunks every interval seconds and reports corrupt
+        ones to the master """
+        try:
+            # zerorpc clients belong to the thread that created them
+            master = zerorpc.Client()
+            master.connect(self.master_ip)
+        except Exception as e:
+            self.print_exception('starting scrubber', e)
+            return
+
+        while True:
+            try:
+                corrupt = self.scrub(rate)
+                if corrupt:
+                    self._report_corrupt(master, corrupt)
+            except Exception as e:
+                self.print_exception('scrubbing chunks', e)
+            time.sleep(interval)
+
+    def scrub(self, rate=SCRUB_RATE):
+        """
+        Verifies every stored chunk against its checksums, reading at most rate MB/s and
+        pausing while client requests are in flight
+        :return: list of corrupt chunkuuids
+        """
+        limiter = zutils.RateLimiter(rate * 1024 * 1024)
+        corrupt = []
+        for chunkuuid in self.chunktable:
+            try:
+                # a mismatch is confirmed by a second pass, it may be a concurrent rewrite
+                if not self._scrub_chunk(chunkuuid, limiter) and \
+                        not self._scrub_chunk(chunkuuid, limiter):
+                    corrupt.append(chunkuuid)
+            except FileNotFoundError:
+                pass  # deleted while scrubbing
+        print("Scrubbed chunks, %d corrupt" % len(corrupt))
+        return corrupt
+
+    def _yield_to_foreground(self):
+        """ Paces the scrubber and compaction by foreground load: pauses SCRUB_BACKOFF per
+        client request in flight, at most SCRUB_MAX_BACKOFF, then carries on.  A busy
+        chunkserver still verifies and compacts its chunks, only more slowly. """
+        inflight = self.inflight
+        if inflight:
+            time.sleep(min(SCRUB_BACKOFF * inflight, SCRUB_MAX_BACKOFF))
+
+    def _scrub_chunk(self, chunkuuid, limiter):
+        """ Returns whether the stored chunk matches all its block checksums """
+        entry = self._packed(chunkuuid)
+        if entry is not None:
+            self._yield_to_foreground()
+            limiter.consume(entry[0])
+            try:
+                self._verify(chunkuuid, self.packs.read(entry[3], entry[4], entry[0]), 0)
+            except ChecksumError:
+                return False
+            return True
+
+        checksums = self._load_checksums(chunkuuid, cache=False)
+        blocks = 0
+        with open(self.chunk_filename(chunkuuid), "rb") as f:
+            while True:
+                self._yield_to_foreground()
+                data = f.read(SCRUB_PIECE)
+                if not data:
+                    break
+                limiter.consume(len(data))
+                try:
+                    self._verify(chunkuuid, data, blocks, checksums)
+                except ChecksumError:
+                    return False
+                blocks += -(-len(data) // CHECKSUM_BLOCK_SIZE)
+        # a truncated or extended chunk has a different number of blocks
+        return blocks == len(checksums) // CHECKSUM_SIZE - 1
+
+    def _report_corrupt(self, master, chunkuuids):
+        """
+        Moves corrupt chunks aside so they are neither served nor confused with fresh copies
+        the master sends, then reports them.  The master keeps the last replica of a chunk,
+        which is moved back; the others are removed.  Packed chunks stay in place and are
+        dropped from the index unless they were rewritten meanwhile.
+        """
+        packed = {}
+        for chunkuuid in chunkuuids:
+            self.checksums.invalidate(chunkuuid)
+            self.cache.invalidate(chunkuuid)
+            if self._packed(chunkuuid):
+                packed[chunkuuid] = self._packed(chunkuuid)
+                continue
+            os.replace(self.chunk_filename(chunkuuid), self.chunk_filename(chunkuuid) + '.corrupt')
+
+        try:
+            dropped = set(master.report_corrupt(self.chunkloc, chunkuuids))
+        except Exception as e:
+            self.print_exception('reporting corrupt chunks', e)
+            dropped = set()
+
+        for chunkuuid in chunkuuids:
+            if chunkuuid in packed:
+                if chunkuuid in dropped:
+                    self.chunktable.remove(chunkuuid, packed[chunkuuid])
+                continue
+
+            quarantined = self.chunk_filename(chunkuuid) + '.corrupt'
+            if os.path.exists(self.chunk_filename(chunkuuid)):
+                os.remove(quarantined)  # a good copy arrived meanwhile
+            elif chunkuuid in dropped:
+                os.remove(quarantined)
+                self.chunktable.remove(chunkuuid)
+                if os.path.exists(self.checksum_filename(chunkuuid)):
+                    os.remove(self.checksum_filename(chunkuuid))
+            else:
+                os.replace(quarantined, self.chunk_filename(chunkuuid))
+
+    @staticmethod
+    def print_exception(context, exception):
+        print("Unexpected error in %s: %s" % (context, type(exception).__name__))
+        traceback.print_exc()
+
+    def digests(self, chunkuuids):
+        """
+        Returns the xxhash digest of each stored chunk, so clients can tell which chunks an
+        edit changes without downloading them.  Digests come from the checksum sidecars.
+        :param chunkuuids:
+        :return: chunkuuid -> digest, None for chunks not stored here
+        """
+        digests = {}
+        for chunkuuid in chunkuuids:
+            try:
+                digests[chunkuuid] = self._load_checksums(chunkuuid)[:CHECKSUM_SIZE]
+            except (IOError, OSError):
+                digests[chunkuuid] = None
+        return digests
+
+    def sizes(self, chunkuuids, compression=None):
+        """
+        Returns the length of stored chunks, from the index so no chunk is read.  Chunks of
+        compressed files are decompressed locally, as their stored size is not their length.
+        :return: chunkuuid -> length, None for chunks not stored here
+        """
+        sizes = {}
+        for chunkuuid in chunkuuids:
+            entry = self.chunktable.get(chunkuuid)
+            if entry is not None and compression:
+                try:
+                    sizes[chunkuuid] = len(zutils.decompress(self.read(chunkuuid), compression))
+                except Exception as e:
+                    print("Failed reading %s: %s" % (chunkuuid, e))
+                    sizes[chunkuuid] = None
+            else:
+                sizes[chunkuuid] = entry[0] if entry is not None else None
+        return sizes
 
     def delete(self, chunkuuids):
+        """
+        Deletes chunks.  Each is moved out of sight at once and unlinked by a background
+        worker, so large batches return quickly and don't hold up reads and writes.
+        :param chunkuuids:
+        :return: {'deleted': number of chunks deleted, 'missing': number not stored here}
+        """
+        counts = {'deleted': 0, 'missing': 0}
         for chunkid in chunkuuids:
-            filename = self.chunk_filename(chunkid)
+            self.checksums.invalidate(chunkid)
+            self.cache.invalidate(chunkid)
+            entry = self.chunktable.remove(chunkid)
+            if entry is not None and entry[3] is not None:
+                counts['deleted'] += 1  # space is reclaimed by compacting its pack file
+                continue
+
+            for filename in (self.checksum_filename(chunkid), self.part_filename(chunkid)):
+                try:
+                    self._trash(filename)
+                except FileNotFoundError:
+                    pass
+
+            try:
+                self._trash(self.chunk_filename(chunkid))
+                counts['deleted'] += 1
+            except FileNotFoundError:
+                counts['missing'] += 1
+
+        print("Deleting %d chunks, %d not found" % (counts['deleted'], counts['missing']))
+        return counts
+
+    def _trash(self, filename):
+        """ Moves a file to the trash directory and queues it for unlinking """
+        trashed = os.path.join(self.trash_root, os.path.basename(filename))
+        os.replace(filename, trashed)
+        self.unlink_queue.put(trashed)
+
+    def _compact_index_forever(self):
+        """ Index thread: compacts the index log off the write path """
+        while True:
+            time.sleep(INDEX_COMPACT_INTERVAL)
             try:
-                if os.path.exists(filename):
-                    print("Removing " + filename)
-                    os.remove(filename)
-                    return True
-            except:
-                None
+                self.chunktable.compact()
+            except Exception as e:
+                self.print_exception('compacting the index log', e)
+
+    def _compact_packs_forever(self):
+        """ Compaction thread: rewrites pack files that are mostly deleted chunks """
+        while True:
+            time.sleep(PACK_COMPACT_INTERVAL)
+            try:
+                self.compact_packs()
+            except Exception as e:
+                self.print_exception('compacting pack files', e)
+
+    def compact_packs(self, garbage=PACK_GARBAGE):
+        """
+        Copies the live chunks of pack files with at least a garbage fraction of deleted
+        bytes into the current pack file and removes them
+        :return: bytes reclaimed
+        """
+        reclaimed = 0
+        for pack, size in self.packs.sizes().items():
+            live = self.chunktable.pack_live.get(pack, 0)
+            if size == 0 or size - live < garbage * size:
+                continue
+
+            new_packs = set()
+            for chunkuuid, entry in self.chunktable.packed_in(pack):
+                self._yield_to_foreground()
+                data = self.packs.read(pack, entry[4], entry[0])
+                new_pack, offset = self.packs.append(data)
+                self.chunktable.relocate(chunkuuid, entry, new_pack, offset)
+                new_packs.add(new_pack)
+
+            if self.group_commit is not None:
+                # the copies and their index records must be durable before the originals
+                # go; this thread is off the event loop, so it fsyncs directly
+                paths = [self.packs.pack_filename(p) for p in new_packs]
+                for path in paths + [self.packs.root, self.chunktable.path]:
+                    GroupCommit.fsync(path)
+            time.sleep(PACK_GRACE)
+            self.packs.remove(pack)
+            self.chunktable.pack_live.pop(pack, None)
+            reclaimed += size - live
+        if reclaimed:
+            print("Compacted pack files, reclaimed %d bytes" % reclaimed)
+        return reclaimed
+
+    def _unlink_forever(self):
+        """ Unlink worker thread """
+        while True:
+            filename = self.unlink_queue.get()
+            try:
+                os.remove(filename)
+            except OSError as e:
+                print("Failed removing %s: %s" % (filename, e.strerror))
 
     def disp(self, a):
         print(str(a) + str(self.chunkloc))
 
     def chunk_filename(self, chunkuuid):
-        local_filename = self.local_filesystem_root + "/" + str(chunkuuid) + '.gfs'
-        return local_filename
+        return self._shard_path(chunkuuid) + '.gfs'
+
+    def checksum_filename(self, chunkuuid):
+        return self._shard_path(chunkuuid) + '.sum'
+
+    def _shard_path(self, chunkuuid):
+        """ Chunks are spread over subdirectories by hash to keep directories small """
+        chunkuuid = str(chunkuuid)
+        shard = xxhash.xxh64_hexdigest(chunkuuid.encode())[:SHARD_DIGITS]
+        return os.path.join(self.local_filesystem_root, shard, chunkuuid)
 
-    def copy_chunk(self, chunkid, chunklocs):
+    def _migrate_flat_layout(self):
+        """ Moves chunks stored directly in the chunk directory, as before subdirectories
+        and the index existed, into their subdirectories and indexes them """
+        migrated = 0
+        for local_filename in os.listdir(self.local_filesystem_root):
+            if not local_filename.endswith('.gfs'):
+                continue
+            chunkuuid = local_filename[:-len('.gfs')]
+            legacy = os.path.join(self.local_filesystem_root, chunkuuid)
+            os.replace(legacy + '.gfs', self.chunk_filename(chunkuuid))
+            if os.path.exists(legacy + '.sum'):
+                os.replace(legacy + '.sum', self.checksum_filename(chunkuuid))
+            digest = self._load_checksums(chunkuuid)[:CHECKSUM_SIZE]
+            self.chunktable.put(chunkuuid, os.path.getsize(self.chunk_filename(chunkuuid)), digest)
+            migrated += 1
+        if migrated:
+            print("Moved %d chunks into subdirectories" % migrated)
+
+    def part_filename(self, chunkuuid):
+        return self.chunk_filename(chunkuuid) + '.part'
+
+    def copy_chunk(self, chunkid, chunklocs, filename=None):
         chunklocs = ast.literal_eval(chunklocs)
         flag = False
         for chunkloc in chunklocs:
             try:
-                chunkserver = self._establish_connection(chunkloc)
-                # TODO md5 check
+                chunkserver = self.peers[chunkloc]
+                # the source verifies its blocks while reading, the digest covers the transfer
                 data = chunkserver.read(chunkid)
-                flag = self.rwrite(chunkid, data)
+                digest = chunkserver.digests([chunkid])[chunkid]
+                if xxhash.xxh64(data).digest() != digest:
+                    print("Copy of chunk %s from loc %s failed checksum" % (chunkid, chunkloc))
+                    continue
+                flag = self.rwrite(chunkid, data, filename)
                 if flag:
                     break
             except Exception as e:
@@ -182,7 +1279,7 @@ class ZChunkserver:
         flag = False
         for chunkloc in chunklocs:
             try:
-                chunkserver = self._establish_connection(chunkloc)
+                chunkserver = self.peers[chunkloc]
                 flag = chunkserver.rwrite(chunkid, data)
                 if flag:
                     break
@@ -192,36 +1289,60 @@ class ZChunkserver:
 
         return flag
 
-    def rename(self, chunkids, filename, newfilename):
-        for chunkid in chunkids:
-            local_filename = self.chunk_filename(chunkid)
-            new_local_filename = local_filename.split('/')
-            new_local_filename[-1] = new_local_filename[-1].replace(filename, newfilename)
-            new_local_filename = '/'.join(new_local_filename)
-            print("Changing %s to %s" % (local_filename, new_local_filename))
-            try:
-                os.rename(local_filename, new_local_filename)
-            except:
-                os.remove(new_local_filename)
-                os.rename(local_filename, new_local_filename)
+    def set_hints(self, chunkuuids, filename):
+        """ Points the hints of stored chunks at the file they belong to after a rename """
+        for chunkuuid in chunkuuids:
+            if chunkuuid in self.chunktable:
+                self.chunktable.set_hint(chunkuuid, filename)
         return True
 
+    def rekey(self, chunks):
+        """
+        Moves chunks stored under ids from before chunk handles to the handles the master
+        gave them, hinting the file each belongs to.  A chunk already moved, e.g. before a
+        crash, only loses its old id.
+        :param chunks: list of (old chunkuuid, handle, filename)
+        :return: handles now stored
+        """
+        rekeyed = []
+        for chunkuuid, handle, filename in chunks:
+            entry = self.chunktable.get(chunkuuid)
+            if entry is None:
+                continue
+            self.checksums.invalidate(chunkuuid)
+            self.cache.invalidate(chunkuuid)
+            own_file = entry[3] is None
+            if handle not in self.chunktable:
+                if own_file and os.path.exists(self.chunk_filename(chunkuuid)):
+                    os.replace(self.chunk_filename(chunkuuid), self.chunk_filename(handle))
+                    if os.path.exists(self.checksum_filename(chunkuuid)):
+                        os.replace(self.checksum_filename(chunkuuid), self.checksum_filename(handle))
+                self.chunktable.put(handle, entry[0], entry[1], entry[3], entry[4])
+            elif own_file:
+                for local_filename in (self.chunk_filename(chunkuuid),
+                                       self.checksum_filename(chunkuuid)):
+                    try:
+                        self._trash(local_filename)
+                    except FileNotFoundError:
+                        pass
+            self.chunktable.set_hint(handle, filename)
+            self.chunktable.remove(chunkuuid)
+            rekeyed.append(handle)
+        print("Re-keyed %d chunks to handles" % len(rekeyed))
+        return rekeyed
+
     def populate(self):
         #print "in populate, chunkloc=", self.chunkloc
-        local_dir = self.chunk_filename("").replace(".gfs", "")
-        #print "local dir is ", local_dir
-        file_list = os.listdir(local_dir)
-        if len(file_list) != 0:
+        # stored chunks come from the index, the chunk directory is not listed
+        if len(self.chunktable) != 0:
             files = {}
-            for items in file_list:
+            for items in self.chunktable:
                 # TODO
                 # if master.exists
                 # read all chunks (in parallel?)
                 # if any xxhash is not the same, os.delete()
                 # else add as regular
-                items = items.replace(".gfs", "")
-                filename = items.split("$%#")[0]
-                self.chunktable[items] = self.chunk_filename(items)
+                filename = self.chunktable.hint(items) or ''  # unknown for pre-handle chunks
                 try:
                     files[filename].append(items)
                 except:
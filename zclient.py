@@ -1,33 +1,65 @@
+import collections
+import io
+import itertools
+import mmap
 import os
-import threading
 import time
 import webbrowser
 import xxhash
 import random
-import multiprocessing as mp
-import traceback
 
+import gevent
 import zerorpc
+from gevent.lock import BoundedSemaphore
+from gevent.pool import Pool
 from kazoo.client import KazooClient
 from kazoo.exceptions import NoNodeError
 from kazoo.recipe.lock import LockTimeout
 from zerorpc.exceptions import LostRemote
 import logging
 
+import zutils
+
 TARGET_CHUNKS = 10
 MIN_CHUNK_SIZE = 1024000
+STREAM_CHUNK_SIZE = 8 * 1024 * 1024  # largest chunk of a streamed file, chunks in flight are buffered
+WRITE_WINDOW = 8  # chunks of a single file in flight at once
+SERVER_WINDOW = 4  # chunks in flight to a single chunkserver at once
+WRITE_RETRIES = 3  # rewrites of a chunk whose digest does not match
+WRITE_SEGMENT = 256 * 1024  # bytes per pipelined segment of a chunk write
+BUFFER_TYPES = (bytes, bytearray, memoryview, mmap.mmap)  # inputs chunked without copying
+READ_WORKERS = 8  # chunks of a single file fetched at once
+READ_TIMEOUT = 10  # seconds to wait on a replica before trying the next one
+CHUNKSERVER_PATH = 'chunkserver/'
+METADATA_CACHE_SIZE = 1024  # files whose metadata the client keeps
+METADATA_TTL = 5  # seconds cached metadata is used without asking the master
 
 
 class ZClient:
-    def __init__(self, zoo_ip='localhost:2181', port=1400):
+    def __init__(self, zoo_ip='localhost:2181', port=1400, write_window=WRITE_WINDOW,
+                 server_window=SERVER_WINDOW, metadata_cache_size=METADATA_CACHE_SIZE,
+                 metadata_ttl=METADATA_TTL, read_workers=READ_WORKERS,
+                 read_timeout=READ_TIMEOUT, hedged_reads=False):
         logging.basicConfig(filename='log.txt')
 
+        self.write_window = write_window
+        self.server_window = server_window
+        self.read_workers = read_workers
+        self.read_timeout = read_timeout
+        self.hedged_reads = hedged_reads  # send a second request to a slow chunk's next replica
+        self.replica_stats = zutils.LatencyTracker()
+        self.write_timings = []  # (chunk index, chunkserver, ms, bytes) of the last _write_chunks
+
         self.master = zerorpc.Client()
         self.zookeeper = KazooClient(hosts=zoo_ip)
+        # chunkserver connections shared by every operation, kept in sync with zookeeper
+        self.chunkserver_pool = zutils.ConnectionPool(directory=lambda: self.master.get('chunkservers'))
+        self.metadata_cache = zutils.MetadataCache(capacity=metadata_cache_size, ttl=metadata_ttl)
 
         # connect to zookeeper for master ip, then connect to master
         master_ip = self._connect_to_zookeeper()
         self._connect_to_master(master_ip)
+        self._watch_chunkservers()
 
     def _connect_to_master(self, master_ip):
         try:
@@ -50,51 +82,72 @@ class ZClient:
 
         return master_ip
 
-    def load(self, filename):
-        with open(filename, 'rb') as f:
-            data = f.read()
+    def _watch_chunkservers(self):
+        """ Keeps the connection pool in step with chunkservers joining and leaving """
+        zutils.watch_chunkservers(self.zookeeper, self.chunkserver_pool, CHUNKSERVER_PATH)
 
-        self.write(filename, data)
+    def load(self, filename, compression=None):
+        """ Uploads a local file, streaming it chunk by chunk instead of reading it whole """
+        with open(filename, 'rb') as f:
+            self.write(filename, f, compression)
 
     def close(self):
-        """Closes connection with master"""
+        """Closes connection with master and chunkservers"""
+        self.chunkserver_pool.close()
         self.master.close()
 
-    def write(self, filename, data):
+    def write(self, filename, data, compression=None):
         """
-        Creates a new file, writes the data
+        Creates a new file, writes the data.  Data is uploaded chunk by chunk, so memory use
+        stays around write_window chunks no matter how large the file is; chunks read from a
+        stream are at most STREAM_CHUNK_SIZE bytes.
         :param filename:
-        :param data:
+        :param data: str, bytes-like (bytes, bytearray, memoryview, mmap), a readable file
+                     object or an iterable of str/bytes pieces
+        :param compression: 'zlib' or 'lzma', optionally with a level ('zlib:1', 'lzma:6').
+                     Chunks are compressed here, stored and replicated compressed and
+                     decompressed by readers.  Ignored when overwriting an existing file,
+                     which keeps its compression.
         """
 
+        if isinstance(data, str):
+            data = data.encode()
+        zutils.parse_compression(compression)
+
         if self._exists(filename):
             self.master.updatevrsn(filename, 1)
             self.edit(filename, data)
         else:
-            seq = 0
-            self.master.updatevrsn(filename, 0)
-
             start = time.time()
 
             try:
                 lock = self.zookeeper.Lock('files/' + filename)
                 lock.acquire(timeout=5)
-                num_chunks, chunksize = self._num_chunks(len(data))
-                # chunkuuids = self.master.alloc(filename, num_chunks, chunksize, seq)
+                size = self._data_size(data)
+                if size is None:
+                    # unknown length, allocate chunk ids a window at a time while streaming
+                    chunksize = MIN_CHUNK_SIZE
+                    num_chunks = self.write_window
+                else:
+                    num_chunks, chunksize = self._num_chunks(
+                        size, stream=not isinstance(data, BUFFER_TYPES))
+                # chunkuuids = self.master.alloc(filename, num_chunks, chunksize)
                 # self._write_chunks(chunkuuids, data, chunksize)
-                chunkuuids = self.master.alloc2(filename, num_chunks, chunksize, seq)
-                if not chunkuuids:
+                chunkuuids = self.master.alloc2(filename, num_chunks, chunksize, compression)
+                if chunkuuids is None:
                     print("No chunkservers online")
                     return None
-                chunklist = self._write_chunks(chunkuuids, data, chunksize)
-                if chunklist:
-                    self._update_master(filename, chunklist)
-                else:
-                    "Failed to write file"
+                if size is None:
+                    chunkuuids = self._alloc_stream(filename, chunkuuids)
+                chunklist = self._write_chunks(filename, chunkuuids,
+                                               self._iter_chunks(data, chunksize), compression)
+                if chunklist is False or not self._update_master(filename, chunklist):
+                    print("Failed to write file")
                     return None
                 end = time.time()
+                size = sum(nbytes for _, _, _, nbytes in self.write_timings)
                 print("Total time writing was %0.2f ms" % ((end - start) * 1000))
-                print("Transfer rate: %0.f MB/s" % (len(data) / 1024 ** 2. / (end - start)))
+                print("Transfer rate: %0.f MB/s" % (size / 1024 ** 2. / (end - start)))
 
             except LockTimeout:
                 return "File in use - try again later"
@@ -102,12 +155,17 @@ class ZClient:
                 lock.release()
 
     def _update_master(self, filename, chunklist):
+        """ Registers written chunks with the master
+        :return: whether the master took them, it fails if it cannot persist the change """
 
         print("File transfer successful. Updating master")
+        self.metadata_cache.invalidate(filename)
         try:
             self.master.update_file(filename, chunklist)
         except Exception as e:
-            print("Error updating master: ")
+            print("Error updating master: %s" % e)
+            return False
+        return True
 
     def _exists(self, filename):
 
@@ -120,101 +178,283 @@ class ZClient:
 
         return response
 
-    def _num_chunks(self, size, chunksize=None):
+    def _file_metadata(self, filename):
+        """
+        Returns the chunk list, chunk locations and chunk size of filename.  Cached metadata
+        younger than the cache ttl costs no RPC; older metadata is kept if the master's
+        version counter has not moved, which costs a single get_version call.  Anything else
+        is fetched with a single open call.
+        :return: metadata dict from ZMaster.open, None if the file does not exist
+        """
+        cached = self.metadata_cache.get(filename)
+        if cached is not None:
+            cached_version, fresh, metadata = cached
+            if fresh:
+                return metadata
+            version = self.master.get_version(filename)
+            if version == cached_version:
+                self.metadata_cache.touch(filename)
+                return metadata
+            self.metadata_cache.invalidate(filename)
+            if version is None:
+                return None
+
+        metadata = self._open(filename)
+        if metadata is not None:
+            self.metadata_cache.put(filename, metadata['version'], metadata)
+        return metadata
+
+    def _open(self, filename):
+        """
+        Fetches chunk list, locations, chunk size, version and the addresses of the
+        chunkservers involved from the master in a single round trip, bypassing the cache.
+        :return: metadata dict from ZMaster.open, None if the file does not exist
+        """
+        metadata = self.master.open(filename)
+        if metadata is not None:
+            self.chunkserver_pool.update(metadata['chunkservers'], complete=False)
+        return metadata
+
+    def _num_chunks(self, size, chunksize=None, stream=False):
+        """
+        :param stream: whether the data is read from a stream; each chunk in flight is then
+                       buffered whole, so chunks are capped at STREAM_CHUNK_SIZE to keep
+                       memory bounded whatever the size of the file
+        :return: (number of chunks, chunksize)
+        """
         if not chunksize:
-            chunksize = max(MIN_CHUNK_SIZE, size / TARGET_CHUNKS)
+            chunksize = max(MIN_CHUNK_SIZE, -(-size // TARGET_CHUNKS))
+            if stream:
+                chunksize = min(chunksize, max(STREAM_CHUNK_SIZE, MIN_CHUNK_SIZE))
+        chunksize = int(chunksize)
         return (size // chunksize) + (1 if size % chunksize > 0 else 0), chunksize
 
-    def _write_chunks(self, chunkuuids, data, chunksize):
-        chunks = [data[x:x + chunksize] for x in range(0, len(data), chunksize)]
+    @staticmethod
+    def _data_size(data):
+        """
+        :return: number of bytes left in data, None if it can only be known by reading it
+        """
+        if isinstance(data, BUFFER_TYPES):
+            return memoryview(data).nbytes
+        try:
+            return os.fstat(data.fileno()).st_size - data.tell()
+        except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+            return None
 
-        # connect with each chunkserver. TODO Change to check/establish later
-        # chunkserver_nums = set(num for numlist in chunkuuids.values() for num in numlist)
-        chunkserver_clients = self._establish_connection()
-        # print "connection established"
-        # raw_input('wait')
-        # chunkuuids is already a table
-        # write to each chunkserver
-
-        finished = False
-        call_replicate = False
-        failed_chunkservers = []
-        while not finished:
-            chunklist = []  # list of successful writes for updating master
-            for idx, (chunkuuid, c_locs) in enumerate(chunkuuids):
-                chunklocs = [c_loc for c_loc in c_locs
-                             if c_loc not in failed_chunkservers]
-                if not chunklocs:
-                    'No chunkservers to write to, write failed'
-                    return False
-                else:
-                    try:
-                        if len(chunklocs) > 1:
-                            chunkloc, chunkloc2 = random.sample(chunklocs, 2)
-                        else:
-                            chunkloc = random.sample(chunklocs, 1)[0]
-                            chunkloc2 = None
-
-                        #print 'chunklocs = %s, chunkloc1 = %s, chunkloc2=%s' % (
-                        #    chunklocs, chunkloc, chunkloc2)
-                        digest = xxhash.xxh64(chunks[idx]).digest()
-                        retdigest = chunkserver_clients[chunkloc].write(chunkuuid, chunks[idx].encode(),
-                                                                        chunkloc2)
-                        i = 3  # maximum amount of retries before we exit
-                        while digest != retdigest:
-                            if i == 0:
-                                print("Failed transferring chunk without errors")
-                                return False
-                            retdigest = chunkserver_clients[chunkloc].write(chunkuuid, chunks[idx].encode(),
-                                                                            chunkloc2)
-                            i -= 1
-
-                        if chunkloc2:
-                            chunklist.append((chunkuuid, [chunkloc, chunkloc2]))
-                        else:
-                            chunklist.append((chunkuuid, [chunkloc]))
-
-                        if idx == len(chunkuuids) - 1:
-                            finished = True
-                    except LostRemote:
-                        failed_chunkservers.append(chunkloc)
-                        finished = False
-                        call_replicate = True
+    @staticmethod
+    def _iter_chunks(data, chunksize):
+        """
+        Lazily splits data into chunks of chunksize bytes (the last one may be shorter).
+        Chunks of bytes, bytearray, memoryview and mmap inputs are memoryviews into the
+        input, so nothing is copied.  Streams are read straight into one buffer per chunk,
+        so only the chunks being uploaded are in memory.
+        :param data: bytes-like, a readable file object or an iterable of str/bytes pieces
+        :return: iterator of bytes-like chunks
+        """
+        if isinstance(data, BUFFER_TYPES):
+            view = memoryview(data).cast('B')
+            for x in range(0, len(view), chunksize):
+                yield view[x:x + chunksize]
+            return
+
+        if hasattr(data, 'readinto'):
+            while True:
+                chunk = memoryview(bytearray(chunksize))
+                filled = 0
+                while filled < chunksize:
+                    n = data.readinto(chunk[filled:])
+                    if not n:
                         break
-                    except Exception as e:
-                        print('Failed writing chunk %d to srv %s' % (idx, chunkloc))
-                        print(e.__doc__, e.message)
-                        #raise
+                    filled += n
+                if filled:
+                    yield chunk[:filled]
+                if filled < chunksize:
+                    return
+
+        if hasattr(data, 'read'):
+            pieces = iter(lambda: data.read(chunksize), data.read(0))
+        else:
+            pieces = iter(data)
+
+        chunk, filled = memoryview(bytearray(chunksize)), 0
+        for piece in pieces:
+            if isinstance(piece, str):
+                piece = piece.encode()
+            piece = memoryview(piece).cast('B')
+            if not filled and len(piece) == chunksize:
+                yield piece
+                continue
+            while len(piece):
+                n = min(len(piece), chunksize - filled)
+                chunk[filled:filled + n] = piece[:n]
+                filled += n
+                piece = piece[n:]
+                if filled == chunksize:
+                    yield chunk
+                    chunk, filled = memoryview(bytearray(chunksize)), 0
+        if filled:
+            yield chunk[:filled]
+
+    @staticmethod
+    def _split_head(data, size):
+        """
+        Splits the first size bytes off data, without copying bytes-like inputs.  The rest of
+        an iterable keeps its own pieces, so it is not re-chunked at the size of the head.
+        :return: (head, rest of data), rest in a form _iter_chunks accepts
+        """
+        if isinstance(data, BUFFER_TYPES):
+            view = memoryview(data).cast('B')
+            return view[:size], view[size:]
+        if hasattr(data, 'read'):
+            head = data.read(size)
+            return head.encode() if isinstance(head, str) else head, data
+
+        pieces = iter(data)
+        head = bytearray()
+        for piece in pieces:
+            if isinstance(piece, str):
+                piece = piece.encode()
+            piece = memoryview(piece).cast('B')
+            needed = size - len(head)
+            head += piece[:needed]
+            if len(piece) >= needed:
+                return head, itertools.chain([piece[needed:]], pieces)
+        return head, pieces
+
+    def _alloc_stream(self, filename, chunkuuids):
+        """
+        Yields allocated (chunkuuid, chunklocs), asking the master for another window of
+        chunks each time they run out.  Used when the length of the data is not known.
+        """
+        while chunkuuids:
+            for entry in chunkuuids:
+                yield entry
+            chunkuuids = self.master.alloc2_chunks(self.write_window, filename)
 
-        #print call_replicate, finished
-        if call_replicate and finished:
-            self.master.replicate()
+    def _write_chunks(self, filename, chunkuuids, chunks, compression=None):
+        """
+        Uploads chunks through a bounded window of concurrent writes.  At most write_window
+        chunks of the file, and server_window chunks per chunkserver, are in flight at once;
+        chunks is only advanced when a slot frees up, so a lazy iterable keeps memory bounded.
+        Each chunk is replicated to all its locations; a chunk whose first chunkserver is lost
+        is retried on its other locations.  Replicas lost along the way are restored by the
+        master once the chunks are registered with update_file.
+        :param filename: file the chunks belong to, kept by chunkservers as a hint
+        :param chunkuuids: ordered (chunkuuid, chunklocs) from the master, one per chunk; the
+                           write fails if they run out before chunks does
+        :param chunks: iterable of chunk contents, in order
+        :param compression: compression of the file, chunks are compressed before uploading
+        :return: ordered list of (chunkuuid, chunklocs) written, False if any chunk failed
+        """
 
-        for client in list(chunkserver_clients.values()):
-            client.close()
+        chunkserver_clients = self._establish_connection()
+        server_slots = collections.defaultdict(lambda: BoundedSemaphore(self.server_window))
+        failed_chunkservers = set()
+        pool = Pool(self.write_window)
+        jobs = []
+
+        start = time.time()
+        chunkuuids = iter(chunkuuids)
+        for idx, chunk in enumerate(chunks):
+            entry = next(chunkuuids, None)
+            if entry is None:
+                # the master ran out of chunkservers to allocate on while streaming
+                print('No chunk allocated for chunk %d, write failed' % idx)
+                pool.join()
+                return False
+            chunkuuid, chunklocs = entry
+            jobs.append(pool.spawn(self._write_chunk, idx, filename, chunkuuid, chunklocs, chunk,
+                                   chunkserver_clients, server_slots, failed_chunkservers,
+                                   compression))
+        pool.join()
+        end = time.time()
+
+        results = [job.value for job in jobs]
+        if not all(results):
+            return False
 
+        chunklist = [chunk_entry for chunk_entry, _, _, _ in results]
+        self.write_timings = [(idx, chunkloc, elapsed * 1000, nbytes)
+                              for idx, (_, chunkloc, elapsed, nbytes) in enumerate(results)]
+        self._print_write_timings(end - start)
         return chunklist
 
-    # TODO only establish necessary target connections here
-    def _establish_connection(self, targets=None):
+    @staticmethod
+    def _write_chunk(idx, filename, chunkuuid, chunklocs, chunk, chunkserver_clients,
+                     server_slots, failed_chunkservers, compression=None):
         """
-        Creates zerorpc client for each chunkserver
-        :return:  Dictionary of zerorpc clients bound to chunkservers
+        Writes a single chunk down a replication chain through all its locations.  Segments
+        are sent to the first chunkserver concurrently and each replica forwards them while
+        storing them, so all replicas receive the chunk in about the time of one transfer.
+        The chunk is acknowledged once every replica has committed it against its digest.
+        Runs inside the write pool; failed_chunkservers is shared by every chunk of the file
+        so a lost chunkserver is skipped by the chunks scheduled after it.
+        :return: ((chunkuuid, chunklocs written), chunkloc, seconds, bytes) or None on failure
         """
-        chunkserver_clients = {}
-        chunkservers = self.master.get('chunkservers')
+        nbytes = memoryview(chunk).nbytes
+        if compression:
+            # the threadpool lets chunks of the window compress in parallel
+            chunk = gevent.get_hub().threadpool.apply(zutils.compress, (chunk, compression))
+        digest = xxhash.xxh64(chunk).digest()
+        view = memoryview(chunk)
+        retries = WRITE_RETRIES  # maximum amount of retries before we exit
+
+        while True:
+            chain = [c_loc for c_loc in chunklocs if c_loc not in failed_chunkservers]
+            if not chain:
+                print('No chunkservers to write chunk %d to, write failed' % idx)
+                return None
+            random.shuffle(chain)
+            chunkloc = chain[0]
 
-        for chunkserver_num, chunkserver_ip in chunkservers.items():
-            zclient = zerorpc.Client()
-            #print 'Client connecting to chunkserver %s at %s' % (chunkserver_num, chunkserver_ip)
             try:
-                zclient.connect(chunkserver_ip)
-                #zclient.print_name()
-                chunkserver_clients[chunkserver_num] = zclient
-            except LostRemote as e:
-                self.master.print_exception('Lost remote in client', None)
+                start = time.time()
+                with server_slots[chunkloc]:
+                    chunkserver = chunkserver_clients[chunkloc]
+                    segments = [gevent.spawn(chunkserver.write_segment, chunkuuid, offset,
+                                             view[offset:offset + WRITE_SEGMENT], chain[1:])
+                                for offset in range(0, len(view), WRITE_SEGMENT)]
+                    # a replica that failed ends the chain for the rest of the write
+                    reached = min((job.get() for job in segments), key=len, default=chain)
+                    written = chunkserver.commit(chunkuuid, len(view), digest, filename,
+                                                 reached[1:])
+                elapsed = time.time() - start
+            except (LostRemote, KeyError):
+                failed_chunkservers.add(chunkloc)
+                continue
+            except Exception as e:
+                print('Failed writing chunk %d to srv %s' % (idx, chunkloc))
+                print(type(e).__name__, e.args)
+                return None
 
-        return chunkserver_clients
+            if not written:
+                if retries == 0:
+                    print("Failed transferring chunk %d without errors" % idx)
+                    return None
+                retries -= 1
+                continue
+
+            if len(written) < len(chain):
+                failed_chunkservers.add(chain[len(written)])
+            return (chunkuuid, written), chunkloc, elapsed, nbytes
+
+    def _print_write_timings(self, total):
+        """ Prints a per-chunk latency summary of the last _write_chunks """
+        if not self.write_timings:
+            return
+        times = sorted(ms for _, _, ms, _ in self.write_timings)
+        print("Wrote %d chunks in %0.2f ms (window %d, %d per chunkserver)" % (
+            len(times), total * 1000, self.write_window, self.server_window))
+        print("Chunk write time: min %0.2f ms, avg %0.2f ms, max %0.2f ms, sum %0.2f ms" % (
+            times[0], sum(times) / len(times), times[-1], sum(times)))
+
+    def _establish_connection(self):
+        """
+        Returns the shared pool of chunkserver clients.  Connections are made lazily on first
+        use of each chunkserver and stay open across operations.
+        :return:  ConnectionPool of zerorpc clients indexed by chunkserver number
+        """
+        return self.chunkserver_pool
 
     def list(self):
         filelist = self.master.list()
@@ -226,272 +466,303 @@ class ZClient:
 
     def read(self, filename):  # get metadata, then read chunks direct
         """
-        Connects to each chunkserver and reads the chunks in order, then
-        assembles the file by reducing
+        Fetches the chunks of the file concurrently from the chunkservers, then
+        assembles them in order
         :param filename:
         :return:  file contents
         """
 
-        if not self._exists(filename):
-            print("Read error - file does not exist")
-
         if filename == "#garbage_collection#":
             print(self.master.get_chunkuuids(filename))
-        else:
-            try:
-                start = time.time()
+            return None
 
-                # lock = self.zookeeper.Lock('files/' + filename)
-                # lock.acquire(timeout=5)
-
-                chunkuuids = self.master.get_chunkuuids(filename)
-                # print "How many chunks? = %d" % len(chunkuuids)
-                chunktable = self.master.get_file_chunks(filename)
-                chunkserver_nums = set(num for numlist in list(chunktable.values()) for num in numlist)
-                # result = set(x for l in v for x in l)
-                chunks = [None] * len(chunkuuids)
-                chunkserver_clients = self._establish_connection(chunkserver_nums)
-                jobs = []
-                failed_chunkservers = []
-                for i, chunkuuid in enumerate(chunkuuids):
-                    chunkloc = chunktable[chunkuuid]
-                    #print chunkloc
-                    flag = False
-                    id = 0
-
-                    while flag is not True:
-                        try:
-                            chunklocs = [c_loc for c_loc in chunktable[chunkuuid] if c_loc not in failed_chunkservers]
-                            lenchunkloc = len(chunklocs)
-                            print('chunklocs = ', chunklocs)
-                            if chunklocs:
-                                next_chunkloc = random.sample(chunklocs, 1)[0]
-                            else:
-                                print('Failed reading file - no chunkservers')
-                                return None
-
-                            print('next chunkloc is ', next_chunkloc)
-                            thread = threading.Thread(
-                                target=self._read(chunkuuid, chunkserver_clients[next_chunkloc],
-                                                  chunks, i))
-                            jobs.append(thread)
-                            thread.start()
-                            flag = True
-                        except:
-                            print('Failed to connect to loc %d' % id)
-                            failed_chunkservers.append(next_chunkloc)
-                            flag = False
-                            id += 1
-                            if id >= lenchunkloc:
-                                print('Failed reading file %s' % filename)
-                                return None
-
-                data = b''.join(chunks)
-                end = time.time()
-                print("Total time reading was %0.2f ms" % ((end - start) * 1000))
-                print("Transfer rate: %0.f MB/s" % (len(data) / 1024 ** 2. / (end - start)))
+        try:
+            start = time.time()
 
-            except LockTimeout:
-                print("File in use - try again later")
+            metadata = self._file_metadata(filename)
+            if metadata is None:
+                print("Read error - file does not exist")
                 return None
-            except Exception as e:
-                print("Error reading file %s" % filename)
-                print(e.__doc__)
-                print(e.message)
+
+            chunks = self._read_chunks(metadata['chunkuuids'], metadata['chunktable'],
+                                       compression=metadata.get('compression'))
+            if chunks is None:
+                print('Failed reading file %s - no chunkservers' % filename)
+                self.metadata_cache.invalidate(filename)
                 return None
-            finally:
-                # lock.release()
-                for client in list(chunkserver_clients.values()):
-                    client.close()
-                pass
 
-        return data
+            data = b''.join(chunks)
+            end = time.time()
+            print("Total time reading was %0.2f ms" % ((end - start) * 1000))
+            print("Transfer rate: %0.f MB/s" % (len(data) / 1024 ** 2. / (end - start)))
 
-    def read_gui(self, filename):
-        data = self.read(filename)
+        except Exception as e:
+            print("Error reading file %s" % filename)
+            print(type(e).__name__, e.args)
+            self.metadata_cache.invalidate(filename)
+            return None
 
-        fdir = "/tmp/gfs/files/"
-        if not os.access(fdir, os.W_OK):
-            os.makedirs(fdir)
-        fn = os.path.abspath('/tmp/gfs/files/' + filename)
-        f = open(fn, 'wb')
-        f.write(data)
-        f.flush()
-        os.fsync(f.fileno())  # ensure data is on disk, f.close() does not ensure fsync itself
-        f.close()
-        webbrowser.open(fn)
+        return data
 
-    def read_mp(self, filename):
+    def read_range(self, filename, offset, length):
         """
-        Connects to each chunkserver and reads the chunks in order, then
-        assembles the file by reducing.  Returns details for editing
+        Reads length bytes of the file starting at offset.  Only the chunks covering the
+        range are fetched, and only the needed slice of the first and last chunk is kept.
+        Chunk boundaries come from the chunksize the master stored when the file was written.
+        Chunks of compressed files are fetched whole and sliced once decompressed.
         :param filename:
-        :param failed_chunkservers
-        :return:  details, file contents
+        :param offset: first byte to read
+        :param length: number of bytes to read, fewer are returned past the end of file
+        :return:  file contents in [offset, offset + length)
         """
 
-        if not self._exists(filename):
-            raise Exception("read error, file does not exist: " + filename)
-
-        if filename == "#garbage_collection#":
-            print(self.master.get_chunkuuids(filename))
-        else:
-            try:
-                lock = self.zookeeper.Lock('files/' + filename)
-                lock.acquire(timeout=5)
-
-                # chunks = []
-                jobs = []
-                chunkuuids = self.master.get_chunkuuids(filename)
-                chunkdetails = []
-                chunktable = self.master.get_file_chunks(filename)
-                chunks = [None] * len(chunkuuids)
-                chunkserver_clients = self._establish_connection()
-                failed_chunkservers = []
-                input('Enter')
-                for i, chunkuuid in enumerate(chunkuuids):
-                    chunkloc = chunktable[chunkuuid]  # TODO FIX ME LATER, reads from [0] below
-
-                    flag = False
-                    id = 0
-                    lenchunkloc = len(chunkloc)
-                    pool = mp.Pool(processes=4)
-                    while flag is not True and id <= lenchunkloc:
-                        #print 'id=', id
-                        try:
-
-                            # thread = threading.Thread(
-                            #     target=self._read(chunkuuid, chunkserver_clients[chunkloc[id]],
-                            #                       chunks, i))
-                            result = pool.apply_async(self._read, args=(chunkuuid,
-                                                                        chunkserver_clients[
-                                                                            chunkloc[id]], chunks,
-                                                                        i))
-                            jobs.append(result)
-                            flag = True
-                        except:
-                            print('Failed to connect to loc %d' % id)
-                            failed_chunkservers.append(chunkloc[id])
-                            flag = False
-                            id += 1
-                            if id >= lenchunkloc:
-                                print('Error reading file %s' % filename)
-                                return None
-
-                # block until all threads are done before reducing chunks
-                for j in jobs:
-                    j.wait()
-
-                data = ''.join(chunks)
-
-                # print chunkdetails
+        if offset < 0 or length < 0:
+            print("Read error - offset and length must not be negative")
+            return None
 
-            except LockTimeout:
-                print("File in use - try again later")
+        try:
+            start = time.time()
+            metadata = self._file_metadata(filename)
+            if metadata is None:
+                print("Read error - file does not exist")
                 return None
-            except:
-                print("Error reading file %s" % filename)
-                raise
-            finally:
-                lock.release()
+            chunksize = metadata['chunksize']
+            chunkuuids = metadata['chunkuuids']
+            if not chunksize:
+                # chunk geometry unknown (e.g. file populated after a master restart)
+                data = self.read(filename)
+                return data[offset:offset + length] if data is not None else None
+
+            pieces = self._range_pieces(offset, length, int(chunksize), len(chunkuuids))
+            if not pieces:
+                return b''
+
+            chunks = self._read_chunks([chunkuuids[i] for i, _, _ in pieces],
+                                       metadata['chunktable'],
+                                       ranges=[(start, size) for _, start, size in pieces],
+                                       compression=metadata.get('compression'))
+            if chunks is None:
+                print('Failed reading file %s - no chunkservers' % filename)
+                self.metadata_cache.invalidate(filename)
+                return None
+            data = b''.join(chunks)
+            end = time.time()
+            print("Read %d bytes from %d chunks in %0.2f ms" % (
+                len(data), len(pieces), (end - start) * 1000))
+        except Exception as e:
+            print("Error reading range of file %s" % filename)
+            print(type(e).__name__, e.args)
+            self.metadata_cache.invalidate(filename)
+            return None
 
-            return data, chunkdetails, chunkserver_clients, failed_chunkservers
+        return data
 
-    def read_with_details(self, filename,failed_chunkservers):  # get metadata, then read chunks direct
+    def read_ranges(self, filename, ranges):
         """
-        Connects to each chunkserver and reads the chunks in order, then
-        assembles the file by reducing.  Returns details for editing
+        Reads several byte ranges of the file, e.g. small records, with a single read_many
+        call per chunkserver.  Slices a chunkserver fails to serve are retried on the other
+        replicas of their chunk.  Compressed files are read by fetching each chunk that any
+        range touches once, whole.
         :param filename:
-        :param failed_chunkservers
-        :return:  details, file contents
+        :param ranges: list of (offset, length)
+        :return:  list with the contents of each range, None if the file could not be read
         """
 
-        if not self._exists(filename):
-            raise Exception("read error, file does not exist: " + filename)
-
-        if filename == "#garbage_collection#":
-            print(self.master.get_chunkuuids(filename))
-        else:
-            try:
-                lock = self.zookeeper.Lock('files/' + filename)
-                lock.acquire(timeout=5)
+        if any(offset < 0 or length < 0 for offset, length in ranges):
+            print("Read error - offset and length must not be negative")
+            return None
 
-                # chunks = []
-                jobs = []
-                chunkuuids = self.master.get_chunkuuids(filename)
-                chunkdetails = []
-                chunktable = self.master.get_file_chunks(filename)
-                chunks = [None] * len(chunkuuids)
-                chunkserver_clients = self._establish_connection()
-                #raw_input('Enter')
-                for i, chunkuuid in enumerate(chunkuuids):
-                    chunkloc = chunktable[chunkuuid]  # TODO FIX ME LATER, reads from [0] below
-                    temp = {'chunkloc': chunkloc,
-                            'chunkuid': chunkuuid}
-                    chunkdetails.append(temp)
-
-                    flag = False
-                    id = 0
-                    lenchunkloc = len(chunkloc)
-                    while flag is not True and id <= lenchunkloc:
-                        #print 'id=', id
-                        try:
-                            thread = threading.Thread(
-                                target=self._read(chunkuuid, chunkserver_clients[chunkloc[id]],
-                                                  chunks, i, temp))
-                            jobs.append(thread)
-                            thread.start()
-                            flag = True
-                        except:
-                            print('Failed to connect to loc %d' % id)
-                            failed_chunkservers.append(chunkloc[id])
-                            flag = False
-                            id += 1
-                            if id >= lenchunkloc:
-                                print('Error reading file %s' % filename)
-                                return None
-
-                # block until all threads are done before reducing chunks
-                for j in jobs:
-                    j.join()
-
-                data = b''.join(chunks)
-
-                # print chunkdetails
+        metadata = self._file_metadata(filename)
+        if metadata is None:
+            print("Read error - file does not exist")
+            return None
 
-            except LockTimeout:
-                print("File in use - try again later")
+        chunksize = metadata['chunksize']
+        if not chunksize:
+            data = self.read(filename)
+            return [data[offset:offset + length] for offset, length in ranges] \
+                if data is not None else None
+
+        chunkuuids = metadata['chunkuuids']
+        chunktable = metadata['chunktable']
+        compression = metadata.get('compression')
+        if compression:
+            pieces = [self._range_pieces(offset, length, int(chunksize), len(chunkuuids))
+                      for offset, length in ranges]
+            needed = sorted(set(i for range_pieces in pieces for i, _, _ in range_pieces))
+            chunks = self._read_chunks([chunkuuids[i] for i in needed], chunktable,
+                                       compression=compression)
+            if chunks is None:
+                print('Failed reading file %s - no chunkservers' % filename)
+                self.metadata_cache.invalidate(filename)
                 return None
-            except:
-                print("Error reading file %s" % filename)
-                raise
-            finally:
-                lock.release()
-                for client in list(chunkserver_clients.values()):
-                    client.close()
+            chunks = dict(zip(needed, chunks))
+            return [b''.join(chunks[i][start:start + size] for i, start, size in range_pieces)
+                    for range_pieces in pieces]
+
+        by_chunkserver = collections.defaultdict(list)  # chunkloc -> [(range, piece, slice)]
+        parts = []  # range -> its pieces' data, in order
+        for idx, (offset, length) in enumerate(ranges):
+            pieces = self._range_pieces(offset, length, int(chunksize), len(chunkuuids))
+            parts.append([None] * len(pieces))
+            for seq, (i, start, size) in enumerate(pieces):
+                chunkloc = self.replica_stats.rank(chunktable[chunkuuids[i]])[0]
+                by_chunkserver[chunkloc].append(((idx, seq), (chunkuuids[i], start, size)))
+
+        chunkserver_clients = self._establish_connection()
+
+        def read_many(chunkloc, group):
+            try:
+                return chunkserver_clients[chunkloc].read_many([s for _, s in group],
+                                                               timeout=self.read_timeout)
+            except Exception as e:
+                print('Failed reading from loc %s: %s' % (chunkloc, type(e).__name__))
+                return [None] * len(group)
+
+        jobs = {chunkloc: gevent.spawn(read_many, chunkloc, group)
+                for chunkloc, group in by_chunkserver.items()}
+        gevent.joinall(list(jobs.values()))
+
+        failed_chunkservers = set()
+        for chunkloc, group in by_chunkserver.items():
+            for (idx, seq), (chunkuuid, start, size), data in zip(*zip(*group), jobs[chunkloc].value):
+                if data is None:
+                    failed_chunkservers.add(chunkloc)
+                    others = [c_loc for c_loc in chunktable[chunkuuid] if c_loc != chunkloc]
+                    data = self._read_chunk(chunkuuid, others, chunkserver_clients,
+                                            failed_chunkservers, start, size)
+                if data is None:
+                    print('Failed reading file %s - no chunkservers' % filename)
+                    self.metadata_cache.invalidate(filename)
+                    return None
+                parts[idx][seq] = data
 
-            return data, chunkdetails, chunkserver_clients, failed_chunkservers
+        return [b''.join(range_parts) for range_parts in parts]
 
     @staticmethod
-    def _read(chunkuuid, chunkserver_client, chunks, i, temp=None):
-        """
-        Gets appropriate chunkserver to contact from master, and retrieves the chunk with
-        chunkuuid. This function is passed to a threading service. Thread safe since each thread
-        accesses only one index.
-        :param chunkuuid:
-        :param chunkserver_client: chunkserver to retrieve chunk from
-        :param chunks: list of chunks we will append this chunk to
-        :param i: current index we are working on
-        :return: Calling threads in this fashion cannot return values, so we pass in chunks
-        """
-        # add md5 check
-
-        chunk = chunkserver_client.read(chunkuuid)
-        chunks[i] = chunk
-        # update temp with chunk for edit details function if exists
-        if temp:
-            temp['chunk'] = chunk
-            # print "Finished reading chunk %s " % chunkuuid
+    def _range_pieces(offset, length, chunksize, num_chunks):
+        """
+        Maps a byte range onto the chunks covering it.  Every chunk but the last is full,
+        appends top up the last chunk before adding new ones.  The range is cut short at the
+        end of the last chunk.
+        :return: list of (chunk index, offset in chunk, length in chunk)
+        """
+        if length <= 0 or offset >= num_chunks * chunksize:
+            return []
+
+        first = offset // chunksize
+        last = min((offset + length - 1) // chunksize, num_chunks - 1)
+        pieces = []
+        for i in range(first, last + 1):
+            start = offset - i * chunksize if i == first else 0
+            end = min(offset + length - i * chunksize, chunksize)
+            pieces.append((i, start, end - start))
+        return pieces
+
+    def _read_chunks(self, chunkuuids, chunktable, failed_chunkservers=None, ranges=None,
+                     compression=None):
+        """
+        Fetches chunks concurrently through a pool of read_workers greenlets.  Each chunk is
+        tried on its replicas in turn until one answers within read_timeout.
+        :param chunkuuids: chunks to read, in order
+        :param chunktable: chunkuuid -> chunklocs
+        :param failed_chunkservers: set of chunkservers known to be failing, updated in place
+        :param ranges: (offset, length) to read of each chunk, whole chunks if None
+        :param compression: compression of the file; chunks are then fetched whole,
+                            decompressed and cut to ranges
+        :return: list of chunk contents in the order of chunkuuids, None if a chunk could not
+                 be read from any replica
+        """
+        chunkserver_clients = self._establish_connection()
+        if failed_chunkservers is None:
+            failed_chunkservers = set()
+        if ranges is None:
+            ranges = [(0, None)] * len(chunkuuids)
+        fetch = [(0, None)] * len(chunkuuids) if compression else ranges
+        pool = Pool(self.read_workers)
+        jobs = [pool.spawn(self._read_chunk, chunkuuid, chunktable[chunkuuid],
+                           chunkserver_clients, failed_chunkservers, offset, length)
+                for chunkuuid, (offset, length) in zip(chunkuuids, fetch)]
+        pool.join()
+
+        chunks = [job.value for job in jobs]
+        if any(chunk is None for chunk in chunks):
+            return None
+        if compression:
+            threadpool = gevent.get_hub().threadpool
+            jobs = [threadpool.spawn(zutils.decompress, chunk, compression) for chunk in chunks]
+            chunks = [job.get()[offset:None if length is None else offset + length]
+                      for job, (offset, length) in zip(jobs, ranges)]
+        return chunks
+
+    def _read_chunk(self, chunkuuid, chunklocs, chunkserver_clients, failed_chunkservers,
+                    offset=0, length=None):
+        """
+        Reads a chunk from the replica with the lowest expected latency, falling back to the
+        others in order.  Replicas that failed for earlier chunks of the same read are tried
+        last.  With hedged_reads, a second request goes to the next replica once the first
+        has been pending longer than the recent latency percentile; the first answer wins.
+        :return: chunk contents (length bytes from offset), None if no replica could serve it
+        """
+        chunklocs = self.replica_stats.rank(chunklocs)
+        chunklocs.sort(key=lambda c_loc: c_loc in failed_chunkservers)
+        hedge = self.hedged_reads
+        pending = {}  # greenlet -> chunkloc
+
+        while chunklocs or pending:
+            if not pending:
+                chunkloc = chunklocs.pop(0)
+                pending[gevent.spawn(self._read_replica, chunkuuid, chunkloc,
+                                     chunkserver_clients, offset, length)] = chunkloc
+
+            deadline = self.replica_stats.deadline() if hedge and chunklocs else None
+            done = gevent.wait(list(pending), timeout=deadline, count=1)
+            if not done:
+                # first replica is slow, hedge once with the next one
+                hedge = False
+                chunkloc = chunklocs.pop(0)
+                pending[gevent.spawn(self._read_replica, chunkuuid, chunkloc,
+                                     chunkserver_clients, offset, length)] = chunkloc
+                continue
+
+            for greenlet in done:
+                chunkloc = pending.pop(greenlet)
+                if greenlet.value is not None:
+                    # a losing hedged request is left to finish, its latency is still recorded
+                    return greenlet.value
+                failed_chunkservers.add(chunkloc)
+        return None
+
+    def _read_replica(self, chunkuuid, chunkloc, chunkserver_clients, offset=0, length=None):
+        """
+        Reads a chunk (or length bytes of it from offset) from one replica and records its
+        latency or failure.
+        :return: chunk contents, None on failure
+        """
+        start = time.time()
+        try:
+            chunk = chunkserver_clients[chunkloc].read(chunkuuid, offset, length,
+                                                       timeout=self.read_timeout)
+        except Exception as e:
+            print('Failed reading chunk from loc %s: %s' % (chunkloc, type(e).__name__))
+            self.replica_stats.record_error(chunkloc)
+            return None
+        self.replica_stats.record(chunkloc, time.time() - start)
+        return chunk
+
+    def read_gui(self, filename):
+        data = self.read(filename)
+
+        fdir = "/tmp/gfs/files/"
+        if not os.access(fdir, os.W_OK):
+            os.makedirs(fdir)
+        fn = os.path.abspath('/tmp/gfs/files/' + filename)
+        f = open(fn, 'wb')
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())  # ensure data is on disk, f.close() does not ensure fsync itself
+        f.close()
+        webbrowser.open(fn)
 
     def dump_metadata(self):
         self.master.dump_metadata()
@@ -521,148 +792,194 @@ class ZClient:
             lock.release()
 
     def _edit_append(self, filename, data):
-        """ Separate function, called if you already have a lock acquired for appending"""
-        if not self._exists(filename):
+        """ Separate function, called if you already have a lock acquired for appending.
+        A short last chunk is topped up first, so every chunk but the last stays chunksize
+        bytes long as read_range and edit expect.  The top-up is staged on the chunk's
+        replicas, the rest of data written as new chunks and registered, and only then is the
+        top-up committed; if that fails the new chunks are deleted again. """
+        metadata = self._open(filename)
+        if metadata is None:
             print("Can't append, file '%s' does not exist" % filename)
             return False
         else:
-            chunksize = self.master.get_chunksize(filename)
-            last_chunk_id = self.master.get_last_chunkuuid(filename)
-            num_chunks, _ = self._num_chunks(len(data), chunksize)
-            seq = int(last_chunk_id.split('$%#')[1]) + 1
-            append_chunkuuids = self.master.alloc2_chunks(num_chunks, filename, seq)
+            if isinstance(data, str):
+                data = data.encode()
+            chunksize = metadata['chunksize']
+            top_up = None
+            if chunksize and metadata['chunkuuids']:
+                staged = self._stage_top_up(filename, metadata, data)
+                if staged is None:
+                    print("Failed topping up the last chunk of %s" % filename)
+                    return False
+                top_up, data = staged
+            size = self._data_size(data)
+            if size is None:
+                num_chunks, chunksize = self.write_window, int(chunksize or MIN_CHUNK_SIZE)
+            else:
+                num_chunks, chunksize = self._num_chunks(size, chunksize)
+            append_chunkuuids = self.master.alloc2_chunks(num_chunks, filename)
             # print "append_chuids", append_chunkuuids
-            if not append_chunkuuids:
+            if append_chunkuuids is None:
                 print("No chunkservers online")
                 return False
-            chunklist = self._write_chunks(append_chunkuuids, data, chunksize)
+            if size is None:
+                append_chunkuuids = self._alloc_stream(filename, append_chunkuuids)
+            chunklist = self._write_chunks(filename, append_chunkuuids,
+                                           self._iter_chunks(data, chunksize),
+                                           metadata.get('compression'))
             # print "chunklist = %s" % chunklist
-            if chunklist:
-                self._update_master(filename, chunklist)
-                return True
-            else:
-                "Failed to write file"
+            if chunklist is False or not self._update_master(filename, chunklist):
+                print("Failed to write file")
                 return False
 
-    def deletechunk(self, filename, chunkdetails, len_newdata, len_olddata, chunksize):
-        x = y = 0
-        chunkids = []
-        for chunkuuid in chunkdetails:
-            if x > len_newdata:
-                chunkids.append(chunkuuid['chunkuid'])
-            x += chunksize
-        self.master.delete_chunks(filename, chunkids)
-        return True
+            if top_up is not None and not self._commit_top_up(filename, metadata, top_up):
+                print("Failed topping up the last chunk of %s" % filename)
+                if chunklist:
+                    self.master.delete_chunks(filename, [chunkuuid for chunkuuid, _ in chunklist])
+                    self.metadata_cache.invalidate(filename)
+                return False
+            return True
 
-    def replacechunk(self, chunkserver_clients, failed_chunkservers, chunkdetails, data1, data2, chunksize):
-        x = y = 0
-        # chunkserver_clients = self._establish_connection()  # can be avoided, pass from the edit function
-        for x in range(0, len(data1), chunksize):
-            if data1[x:x + chunksize] != data2[x:x + chunksize] or len(
-                    data2[x:x + chunksize]) < chunksize:
-                #print "replace '" + data1[x:x + chunksize] + "' with '" + data2[
-                #                                                         x:x + chunksize] + "'"
-                validservers = list(set(chunkdetails[y]['chunkloc']) - set(failed_chunkservers))
-                for i in validservers:
-                    try:
-                        chunkserver_clients[i].write(chunkdetails[y]['chunkuid'],
-                                                     data2[x:x + chunksize])
-                    except:
-                        pass
-
-            y += 1
-        return True
+    def _stage_top_up(self, filename, metadata, data):
+        """
+        Sends the start of data that fits in a short last chunk to the chunk's replicas, down
+        a replication chain like _write_chunk, without making it readable.  The length of the
+        last chunk comes from a replica's index, none of the chunk is downloaded.
+        :return: (top-up for _commit_top_up, rest of data), top-up None if the last chunk
+                 is full; None on failure
+        """
+        chunksize = int(metadata['chunksize'])
+        chunkuuid = metadata['chunkuuids'][-1]
+        chunklocs = self.replica_stats.rank(metadata['chunktable'][chunkuuid])
+        compression = metadata.get('compression')
+        chunkserver_clients = self._establish_connection()
 
-    # def append(self, filename, data):
-    #     if not self._exists(filename):
-    #         raise Exception("append error, file does not exist: " + filename)
-    #     else:
-    #         num_chunks = self._num_chunks(len(data))
-    #         chunkuuids = self.master.get_chunkuuids(filename)[-1]
-    #         seq = int(chunkuuids.split('$%#')[1]) + 1
-    #         append_chunkuuids = self.master.alloc_append(num_chunks, filename, seq)
-    #         self._write_chunks(append_chunkuuids, data)
+        length = None
+        for chunkloc in chunklocs:
+            try:
+                length = chunkserver_clients[chunkloc].sizes([chunkuuid], compression)[chunkuuid]
+            except Exception as e:
+                print('Failed getting chunk size from loc %s: %s' % (chunkloc, type(e).__name__))
+            if length is not None:
+                break
+        if length is None:
+            return None
+        if length >= chunksize:
+            return None, data
+
+        head, data = self._split_head(data, chunksize - length)
+        if not len(head):
+            return None, data
+        view = memoryview(head)
+        try:
+            chunkserver = chunkserver_clients[chunklocs[0]]
+            segments = [gevent.spawn(chunkserver.write_segment, chunkuuid, length + offset,
+                                     view[offset:offset + WRITE_SEGMENT], chunklocs[1:])
+                        for offset in range(0, len(view), WRITE_SEGMENT)]
+            chain = min((job.get() for job in segments), key=len)
+        except Exception as e:
+            print('Failed sending top-up of chunk %s: %s' % (chunkuuid, type(e).__name__))
+            return None
+        return (chunkuuid, length, len(view), xxhash.xxh64(view).digest(), chain), data
+
+    def _commit_top_up(self, filename, metadata, top_up):
+        """
+        Appends a top-up staged by _stage_top_up to the last chunk on the replicas that
+        received it.  Replicas left behind are reported to the master as stale.
+        :return: whether any replica committed it
+        """
+        chunkuuid, length, size, digest, chain = top_up
+        try:
+            committed = self._establish_connection()[chain[0]].commit_append(
+                chunkuuid, length, length + size, digest, filename,
+                metadata.get('compression'), chain[1:])
+        except Exception as e:
+            print('Failed committing top-up of chunk %s: %s' % (chunkuuid, type(e).__name__))
+            return False
+        if not committed:
+            return False
+
+        self.metadata_cache.invalidate(filename)
+        missed = [chunkloc for chunkloc in metadata['chunktable'][chunkuuid]
+                  if chunkloc not in committed]
+        if missed:
+            try:
+                self.master.report_stale(chunkuuid, missed)
+            except Exception as e:
+                print('Failed reporting stale replicas of chunk %s: %s' % (
+                    chunkuuid, type(e).__name__))
+                return False
+        return True
 
     def delete(self, filename):
         if not self._exists(filename):
             raise Exception("append error, file does not exist: " + filename)
         else:
             self.master.delete(filename, "")
+            self.metadata_cache.invalidate(filename)
 
     def edit(self, filename, newdata):
         """
-        Read the file with the read() from above and update only the
-        chunkservers where the data in the chunk has changed
+        Replaces the contents of the file with newdata, uploading only the chunks that
+        changed.  Chunkservers report the digest of each stored chunk, which is compared
+        with the digest of the matching slice of newdata, so the old contents never cross the
+        network.  newdata is streamed chunk by chunk like in write().
+        :param filename:
+        :param newdata: str, bytes, a readable file object or an iterable of str/bytes pieces
         """
 
-        if not self._exists(filename):
-            raise Exception("read error, file does not exist: " + filename)
-
-        # TODO possibly change, read acquires full lock so this can't happen after asking lock below
-        # kazoo lock is not reentrant, so it will block forever if the same thread acquires twice
-        olddata, chunkdetails, chunkservers, failed_chunkservers = self.read_with_details(filename, [])
-
-        if not olddata:
-            return False  # exit if unable to read details
+        if isinstance(newdata, str):
+            newdata = newdata.encode()
 
         try:
             lock = self.zookeeper.Lock('files/' + filename)
             lock.acquire(timeout=5)
-            chunks = []
-            i = 0
-            chunkuuids = self.master.get_chunkuuids(filename)
-            # chunkserver_clients = self._establish_connection()
-            #
-            # for chunkuuid in chunkuuids:
-            #   temp={}
-            # maybe use subprocess to execute the download process in parallel
-            # may throw error if chunkserver dies off in between
-            #   chunkloc = self.master.get_chunkloc(chunkuuid)
-            #   chunk = chunkserver_clients[chunkloc[0]].read(chunkuuid)
-            #   temp['chunkloc']=chunkloc
-            #   temp['chunkuid']=chunkuuid
-            #   temp['chunk']=chunk
-            #   chunkdetails.append(temp)
-            #   chunks.append(chunk)
-
-            # olddata = reduce(lambda x, y: x + y, chunks)  # reassemble in order
-
-            # print "\nCurrent data in " + filename + "\n" + olddata + "\nEdited data:\n" + newdata
-
-            # newchunks = []
-            # chunksize = self.master.get('chunksize')
-            chunksize = self.master.get_chunksize(filename)
-            len_newdata = len(newdata)
-            len_olddata = len(olddata)
-            # newchunks = [newdata[x:x + chunksize] for x in range(0, len_newdata, chunksize)]
-
-            if len_newdata == len_olddata:
-                if newdata == olddata:
-                    print("no change in contents")
-                else:
-                    print("same size but content changed")
-                    x = self.replacechunk(chunkservers, failed_chunkservers, chunkdetails, olddata, newdata, chunksize)
-            elif len_newdata < len_olddata:
-                print("deleted some contents")
-                x = self.replacechunk(chunkservers, failed_chunkservers, chunkdetails,
-                                      olddata[0:len_newdata], newdata, chunksize)
-                #print "call fn() to delete chunks " + olddata[
-                                                     # len_newdata + 1:] + " from chunk server"
-                x = self.deletechunk(filename, chunkdetails, len_newdata, len_olddata, chunksize)
-            elif len_newdata > len_olddata:
-                print("added some contents")
-                x = self.replacechunk(chunkservers, failed_chunkservers, chunkdetails, olddata,
-                                      newdata[0:len_olddata], chunksize)
-                #print "call fn() to add chunks '" + newdata[len_olddata + 1:] + "' to chunk server"
-                x2 = self._edit_append(filename, newdata[len_olddata:])
 
-            self.master.updatevrsn(filename, 1)
+            metadata = self._open(filename)
+            if metadata is None:
+                raise Exception("read error, file does not exist: " + filename)
+
+            chunkuuids = metadata['chunkuuids']
+            chunktable = metadata['chunktable']
+            chunksize = int(metadata['chunksize'] or MIN_CHUNK_SIZE)
+            compression = metadata.get('compression')
+            chunkserver_clients = self._establish_connection()
+            old_digests = self._chunk_digests(chunkuuids, chunktable, chunkserver_clients)
+
+            failed_chunkservers = set()
+            pool = Pool(self.write_window)
+            jobs = []
+            num_new = 0
+            chunks = self._iter_chunks(newdata, chunksize)
+            for chunk in chunks:
+                if num_new == len(chunkuuids):
+                    # file grew, the rest of newdata is appended as new chunks once the
+                    # replaced ones, which append may top up, are written
+                    pool.join()
+                    if not self._edit_append(filename, itertools.chain([chunk], chunks)):
+                        print("Failed appending to file %s" % filename)
+                        return False
+                    break
+                chunkuuid = chunkuuids[num_new]
+                if compression:
+                    # compression is deterministic, so unchanged chunks keep their digest
+                    chunk = zutils.compress(chunk, compression)
+                if xxhash.xxh64(chunk).digest() != old_digests.get(chunkuuid):
+                    jobs.append(pool.spawn(self._replace_chunk, chunkuuid, chunktable[chunkuuid],
+                                           chunk, chunkserver_clients, failed_chunkservers))
+                num_new += 1
+            pool.join()
+
+            if not all(job.value for job in jobs):
+                print("Failed replacing chunks of file %s" % filename)
+                return False
+            if num_new < len(chunkuuids):
+                self.master.delete_chunks(filename, chunkuuids[num_new:])
 
-            try:
-                for chunkserver in chunkservers:
-                    chunkserver.close()
-            except:
-                pass
+            print("Edit replaced %d of %d chunks" % (len(jobs), len(chunkuuids)))
+            self.master.updatevrsn(filename, 1)
+            self.metadata_cache.invalidate(filename)
+            return True
 
         except LockTimeout:
             print("File in use - try again later")
@@ -673,25 +990,75 @@ class ZClient:
         finally:
             lock.release()
 
-    def rename(self, filename, newfilename):
-        if self._exists(filename):
-            if not self._exists(newfilename):
-                chunkuids = self.master.get_chunkuuids(filename)
-                result = {}
-                for chunkuid in chunkuids:
-                    # maybe use subprocess to execute the download process in parallel
-                    # may throw error if chunkserver dies off in between
-                    chunklocs = self.master.get_chunkloc(chunkuid)
-                    for chunkloc in chunklocs:
-                        try:
-                            result[chunkloc].append(chunkuid)
-                        except:
-                            result[chunkloc] = []
-                            result[chunkloc].append(chunkuid)
-
-                    self.master.rename(result, filename, newfilename)
+    def _chunk_digests(self, chunkuuids, chunktable, chunkserver_clients):
+        """
+        Asks chunkservers for the digests of stored chunks, one batched call per chunkserver.
+        :return: chunkuuid -> digest, missing for chunks no chunkserver could report
+        """
+        by_chunkserver = collections.defaultdict(list)
+        for chunkuuid in chunkuuids:
+            chunklocs = self.replica_stats.rank(chunktable[chunkuuid])
+            if chunklocs:
+                by_chunkserver[chunklocs[0]].append(chunkuuid)
 
-            else:
-                print("read error, file already exist: " + newfilename)
-        else:
-            print("read error, file does not exist: " + filename)
+        def digests(chunkloc, chunkids):
+            try:
+                return chunkserver_clients[chunkloc].digests(chunkids)
+            except Exception as e:
+                print('Failed getting digests from loc %s: %s' % (chunkloc, type(e).__name__))
+                return {}
+
+        jobs = [gevent.spawn(digests, chunkloc, chunkids)
+                for chunkloc, chunkids in by_chunkserver.items()]
+        gevent.joinall(jobs)
+
+        old_digests = {}
+        for job in jobs:
+            old_digests.update((chunkid, digest) for chunkid, digest in job.value.items() if digest)
+        return old_digests
+
+    def _replace_chunk(self, chunkuuid, chunklocs, chunk, chunkserver_clients,
+                       failed_chunkservers):
+        """
+        Overwrites an existing chunk on each of its replicas.  Replicas the write misses are
+        reported to the master, which drops them and copies the new contents to the chunk's
+        other chunkservers before answering, so no replica keeps serving the old contents.
+        :return: list of replicas written, None if none could be or the missed ones could not
+                 be reported
+        """
+        digest = xxhash.xxh64(chunk).digest()
+        written = []
+        for chunkloc in chunklocs:
+            if chunkloc in failed_chunkservers:
+                continue
+            try:
+                if chunkserver_clients[chunkloc].write(chunkuuid, chunk) == digest:
+                    written.append(chunkloc)
+                else:
+                    print('Digest mismatch replacing chunk on loc %s' % chunkloc)
+            except Exception as e:
+                print('Failed replacing chunk on loc %s: %s' % (chunkloc, type(e).__name__))
+                failed_chunkservers.add(chunkloc)
+
+        missed = [chunkloc for chunkloc in chunklocs if chunkloc not in written]
+        if written and missed:
+            try:
+                self.master.report_stale(chunkuuid, missed)
+            except Exception as e:
+                print('Failed reporting stale replicas of chunk %s: %s' % (
+                    chunkuuid, type(e).__name__))
+                return None
+        return written or None
+
+    def rename(self, filename, newfilename):
+        """
+        Renames a file.  Chunks are named by handle, so this only changes the master's
+        namespace; the master checks that filename exists and newfilename does not.
+        :return: whether the file was renamed
+        """
+        renamed = self.master.rename(filename, newfilename)
+        self.metadata_cache.invalidate(filename)
+        self.metadata_cache.invalidate(newfilename)
+        if not renamed:
+            print("rename error, %s does not exist or %s already exists" % (filename, newfilename))
+        return bool(renamed)
@@ -1,12 +1,15 @@
-import ast
+import os
+import queue
 import random
 import sys
 import threading
 import time
-import uuid
 import getpass
 import traceback
+from array import array
 
+import msgpack
+import xxhash
 import zerorpc
 from apscheduler.schedulers.background import BackgroundScheduler
 from kazoo.client import KazooClient
@@ -15,34 +18,180 @@ import zutils
 
 CHUNKSERVER_PATH = 'chunkserver/'
 UPDATE_FREQUENCY = 5  # update frequency in seconds
+HANDLE_CLOCK_BITS = 24  # low bits of a chunk handle count allocations, the rest is the start time
+# chunks stored under ids from before handles get handles below 2 ** LEGACY_HANDLE_BITS, under
+# the clock-based ones, with their sequence number in the low LEGACY_SEQ_BITS
+LEGACY_HANDLE_BITS = 54
+LEGACY_SEQ_BITS = 20
+VERSION_CLOCK_BITS = 24  # low bits of a file version count changes, the rest is the start time
+METADATA_ROOT = '/tmp/gfs/master/'  # checkpoint and operation log of the master's metadata
+CHECKPOINT_INTERVAL = 60  # seconds between checkpoints, taken only if metadata changed
+REPORT_GRACE = 300  # seconds a restored master waits for chunkservers to report their chunks
+
+
+def handle_str(handle):
+    """ Chunk handles are 64 bit numbers, sent and stored by chunkservers as 16 hex digits """
+    return '%016x' % handle
+
+
+def parse_handle(chunkid):
+    """ Reverses handle_str, raising ValueError for ids that are not chunk handles """
+    if len(chunkid) != 16:
+        raise ValueError('not a chunk handle: %r' % chunkid)
+    return int(chunkid, 16)
+
+
+def legacy_handle(chunkid):
+    """
+    Maps a chunk id from before handles, filename$%#seq$%#uuid, to a handle.  The handle is
+    derived from the filename and sequence number only, so replicas on different chunkservers
+    get the same one, even across master restarts, and a file's chunks sort in sequence order
+    ahead of chunks appended after the migration.
+    :return: (filename, handle), (None, None) if chunkid is not a legacy chunk id
+    """
+    parts = chunkid.rsplit('$%#', 2)
+    if len(parts) != 3 or not parts[1].isdigit() or int(parts[1]) >> LEGACY_SEQ_BITS:
+        return None, None
+    filename, seq = parts[0], int(parts[1])
+    prefix = xxhash.xxh64_intdigest(filename.encode()) >> (64 - LEGACY_HANDLE_BITS + LEGACY_SEQ_BITS)
+    return filename, prefix << LEGACY_SEQ_BITS | seq
+
+
+class OpLog:
+    """ Persists the master's metadata as a checkpoint, a msgpack snapshot of its tables, and
+    an append-only log of the changes made after it.  Every checkpoint starts a new log
+    generation.  A restart loads the checkpoint and replays the logs of its generation and
+    the later ones, so a crash while a checkpoint is written loses nothing. """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.generation = 0
+        self.records = 0  # records logged since the last checkpoint
+        self.log = None
+
+    def _log_path(self, generation):
+        return os.path.join(self.root, 'oplog.%d' % generation)
+
+    def _generations(self):
+        return sorted(int(name.split('.')[1]) for name in os.listdir(self.root)
+                      if name.startswith('oplog.') and name.split('.')[1].isdigit())
+
+    def load(self):
+        """
+        Reads the latest checkpoint and the records logged after it, dropping a record torn
+        by a crash, then opens the newest log for appending
+        :return: (checkpoint, records), checkpoint None if there is none
+        """
+        checkpoint = None
+        try:
+            with open(os.path.join(self.root, 'checkpoint'), 'rb') as f:
+                checkpoint = msgpack.unpackb(f.read(), raw=False)
+            self.generation = checkpoint['generation']
+        except FileNotFoundError:
+            pass
+
+        records = []
+        for generation in self._generations():
+            if generation < self.generation:
+                os.remove(self._log_path(generation))  # folded into the checkpoint
+                continue
+            with open(self._log_path(generation), 'r+b') as f:
+                unpacker = msgpack.Unpacker(f, raw=False)
+                end = 0
+                for record in unpacker:
+                    records.append(record)
+                    end = unpacker.tell()
+                f.truncate(end)
+            self.generation = generation
+
+        self.records = len(records)
+        self.log = open(self._log_path(self.generation), 'ab')
+        return checkpoint, records
+
+    def append(self, record):
+        """ Persists a record before the change it describes is acknowledged """
+        self.log.write(msgpack.packb(record, use_bin_type=True))
+        self.log.flush()
+        os.fsync(self.log.fileno())
+        self.records += 1
+
+    def rotate(self):
+        """ Starts the log generation of a checkpoint about to be taken, later changes are
+        logged there.  The caller holds the master's lock.
+        :return: the new generation """
+        self.log.close()
+        self.generation += 1
+        self.records = 0
+        self.log = open(self._log_path(self.generation), 'ab')
+        return self.generation
+
+    def checkpoint(self, generation, data):
+        """ Replaces the checkpoint with packed tables taken at the start of generation, and
+        removes the logs they cover """
+        path = os.path.join(self.root, 'checkpoint')
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        for older in self._generations():
+            if older < generation:
+                os.remove(self._log_path(older))
+
+    def close(self):
+        self.log.close()
 
 
 class ZMaster:
-    def __init__(self, zoo_ip='localhost:2181', master_port=1400):
+    def __init__(self, zoo_ip='localhost:2181', master_port=1400, metadata_root=METADATA_ROOT):
         self.lock = threading.RLock()  # lock for modifying metadata
         self.num_chunkservers = 0
         self.last_updated = 0  # time since last stats poll
         self.ip = zutils.get_myip() + ':' + str(master_port)
         # self.chunksize = 10
         self.chunkrobin = 0
-        self.versntable = {}  # file version counter
+        self.versntable = {}  # filename -> version, changes whenever its metadata does
+        # versions come from one increasing counter, so a name never gets the same version
+        # twice, not even across delete and create.  Starting from the clock keeps them
+        # ahead of the versions handed out before a master restart.
+        self.version_counter = int(time.time()) << VERSION_CLOCK_BITS
         # self.filetable = {'#garbage_collection#': {'0000000024': [
-        #    'abc$%#0$%#27a04c46-9c4f-11e5-92b7-000c29c12a87']}}  # file to chunk mapping
-        self.filetable = {'#garbage_collection#': {}}
-        self.chunktable = {}  # chunkuuid to chunkloc mapping
+        #    0x1f2e3d4c00000005]}}  # file to chunk mapping
+        self.filetable = {'#garbage_collection#': {}}  # filename -> array of chunk handles
+        self.chunktable = {}  # chunk handle to tuple of chunklocs
+        self.serverchunks = {}  # chunkloc to set of chunk handles, the inverse of chunktable
+        # chunks refer to their file by an id that survives renames, see _file_id
+        self.chunkfile = {}  # chunk handle -> id of the file it belongs to
+        self.fileids = {}  # filename -> file id
+        self.filenames = {}  # file id -> filename, the inverse of fileids
+        self.next_fileid = 0
+        # handles only grow, so a file's chunks sort in handle order.  Starting from the clock
+        # keeps them unique across master restarts.
+        self.next_handle = int(time.time()) << HANDLE_CLOCK_BITS
+        self.handle_lock = threading.Lock()
         self.chunkservers = {}  # loc id to chunkserver mapping
         self.no_replica = 3
         # self.init_chunkservers()
         self.chunkclients = {}  # zerorpc clients connected to chunkservers
         self.chunkstats = {}  # stats for capacity and network load
         self.chunksize = {}  # filename -> chunksize mapping
+        self.compression = {}  # filename -> compression of its chunks, see zutils.compress
+        self.oplog = OpLog(metadata_root)
+        # with metadata restored, chunk reports only confirm locations of known chunks
+        self.restored = self._restore()
+        # restored chunks have no locations until chunkservers report them, see _awaiting_reports
+        self.reports_due = time.time() + REPORT_GRACE if self.restored else 0
         self.zookeeper = KazooClient(hosts=zoo_ip)
         self._register_with_zookeeper(master_port)
+        self.hint_queue = queue.Queue()  # ids of renamed files whose chunk hints are out of date
+        threading.Thread(target=self._update_hints_forever, daemon=True).start()
 
         # this schedules background tasks in separate thread
         scheduler = BackgroundScheduler()
         scheduler.add_job(self.collect_garbage, 'interval', minutes=10)
         scheduler.add_job(self.replicate, 'interval', minutes=5)
+        scheduler.add_job(self.checkpoint, 'interval', seconds=CHECKPOINT_INTERVAL)
         scheduler.start()
 
     def _register_with_zookeeper(self, master_port):
@@ -98,18 +247,20 @@ class ZMaster:
                     try:
                         removed_servers = [chunkserver_num for chunkserver_num in self.chunkservers
                                            if chunkserver_num not in children]
+                        affected = set()
                         for chunkserver_num in removed_servers:
-                            self._unregister_chunkserver(chunkserver_num)
+                            affected.update(self._unregister_chunkserver(chunkserver_num))
                             print("Chunkserver %s was removed" % chunkserver_num)
 
                         self.num_chunkservers = len(self.chunkservers)
                         #print "Now %d chunksrv" % self.num_chunkservers
-                        #print "Calling replicate directly"
-                        self.replicate()
                     except Exception as ex:
                         self.print_exception('Removing chunkserver', ex)
+                        affected = set()
                     finally:
                         self.lock.release()
+                    # copies are made outside the lock, see replicate
+                    self.replicate(affected)
         except Exception as e:
             self.print_exception('connecting to zookeeper', e)
             print("Unable to connect to zookeeper - master shutting down")
@@ -133,6 +284,7 @@ class ZMaster:
             files, chunkloc = c.populate()
             if files:
                 print('Populating files from server %s' % chunkserver_num)
+                files = self._migrate_legacy(c, files)
                 self.populate(files, chunkloc)
 
             self.chunkclients[chunkserver_num] = c
@@ -147,25 +299,84 @@ class ZMaster:
         finally:
             self.lock.release()
 
+    def _migrate_legacy(self, chunkserver, files):
+        """
+        Has a registering chunkserver re-key the chunks it stores under ids from before
+        handles to their handles, see legacy_handle.  A chunk whose handle belongs to another
+        file is left alone.
+        :param files: filename hint -> chunk ids, from the chunkserver's populate
+        :return: files with the re-keyed chunks listed by handle under their filename
+        """
+        legacy = []
+        for chunkuuids in files.values():
+            for chunkuuid in chunkuuids:
+                filename, chunkid = legacy_handle(chunkuuid)
+                if chunkid is None:
+                    continue
+                if chunkid in self.chunkfile and self._chunk_file(chunkid) != filename:
+                    print("Handle of legacy chunk %s belongs to %s, not migrated" % (
+                        chunkuuid, self._chunk_file(chunkid)))
+                    continue
+                legacy.append((chunkuuid, handle_str(chunkid), filename))
+        if not legacy:
+            return files
+
+        rekeyed = set(chunkserver.rekey(legacy))
+        migrated = set(chunkuuid for chunkuuid, handle, _ in legacy if handle in rekeyed)
+        files = {filename: [chunkuuid for chunkuuid in chunkuuids if chunkuuid not in migrated]
+                 for filename, chunkuuids in files.items()}
+        for chunkuuid, handle, filename in legacy:
+            if chunkuuid in migrated:
+                files.setdefault(filename, []).append(handle)
+        print("Migrated %d legacy chunks to handles" % len(migrated))
+        return files
+
     def _unregister_chunkserver(self, chunkserver_num):
+        """
+        Forgets a departed chunkserver and its replicas.  Only the chunks it held are
+        visited, through serverchunks.  Files left with a chunk that has no replica are
+        deleted, unless a restored master is still waiting for chunk reports.
+        :return: handles of the chunks that lost a replica, for replicate
+        """
 
         # called inside watch children, metadata lock already acquired
         del self.chunkservers[chunkserver_num]
         del self.chunkclients[chunkserver_num]
-        for filename, chunkid_list in list(self.filetable.items()):
-            for chunkid in chunkid_list:
-                if chunkserver_num in self.chunktable[chunkid]:
-                    print("Removing %s from %s " % (chunkserver_num, chunkid))
-                    self.chunktable[chunkid].remove(chunkserver_num)
-                    if not self.chunktable[chunkid]:
-                        self.print_exception("List is empty now, deleting file %s " % filename,
-                                             None)
-                        self.delete(filename, '')
-                        break  # breaks inner for loop
-
-                        # print "\t Chunktable = ", self.chunktable
-                        # print "\t Filetable = ", self.filetable
-                        # print "\t Chunkservers = ", self.chunkservers
+        self.chunkstats.pop(chunkserver_num, None)
+        chunkids = self.serverchunks.pop(chunkserver_num, set())
+        lost_files = set()
+        for chunkid in chunkids:
+            self._remove_chunkloc(chunkid, chunkserver_num)
+            filename = self._chunk_file(chunkid)
+            self._bump_version(filename)
+            if not self.chunktable[chunkid]:
+                lost_files.add(filename)
+        print("Removed %s from %d chunks" % (chunkserver_num, len(chunkids)))
+
+        if lost_files and self._awaiting_reports():
+            print("Keeping %d files without replicas, chunkservers are still reporting" %
+                  len(lost_files))
+            return chunkids
+        for filename in lost_files:
+            if filename in self.filetable:
+                self.print_exception("List is empty now, deleting file %s " % filename, None)
+                try:
+                    self.delete(filename, '')
+                except OSError as e:
+                    self.print_exception('deleting file %s' % filename, e)
+        return chunkids
+
+    def _awaiting_reports(self):
+        """ Whether a restored master still waits for chunkservers to report the chunks it
+        restored without locations.  Until every chunk has a replica or REPORT_GRACE is over,
+        a chunk without one may be stored on a chunkserver that has not registered yet. """
+        if not self.reports_due:
+            return False
+        if time.time() < self.reports_due and \
+                any(not chunklocs for chunklocs in self.chunktable.values()):
+            return True
+        self.reports_due = 0
+        return False
 
     @staticmethod
     def print_exception(context, exception, message=''):
@@ -174,19 +385,126 @@ class ZMaster:
             traceback.print_exc()
             # print(type(exception).__name__, ': ', exception.args)
 
+    def _restore(self):
+        """
+        Loads the metadata of the previous master: the latest checkpoint, then the changes
+        logged after it.  Chunk locations are not persisted, chunkservers report them as they
+        register.  Chunks awaiting garbage collection are not either, chunkservers report
+        them as unknown chunks.
+        :return: whether there was metadata to load
+        """
+        checkpoint, records = self.oplog.load()
+        if checkpoint is None and not records:
+            return False
+
+        if checkpoint is not None:
+            for filename, packed in checkpoint['filetable'].items():
+                chunkids = array('Q')
+                chunkids.frombytes(packed)
+                self._redo(['chunks', filename, chunkids])
+            self.chunksize.update(checkpoint['chunksize'])
+            self.compression.update(checkpoint['compression'])
+            self.next_handle = max(self.next_handle, checkpoint['next_handle'])
+        for record in records:
+            self._redo(record)
+
+        # versions are not persisted, fresh ones keep clients from trusting metadata they
+        # cached from the previous master
+        for filename in self.list():
+            self._bump_version(filename)
+        print("Restored %d files and %d chunks, replayed %d logged changes" % (
+            len(self.filetable) - 1, len(self.chunktable), len(records)))
+
+        if records:
+            self.checkpoint()
+        return True
+
+    def _redo(self, record):
+        """ Applies a logged change to the tables, leaving chunk locations to chunk reports """
+        op, filename = record[0], record[1]
+        if op == 'file':
+            self.chunksize[filename] = record[2]
+            if record[3]:
+                self.compression[filename] = record[3]
+            else:
+                self.compression.pop(filename, None)
+        elif op == 'chunks':
+            chunkids = self.filetable.setdefault(filename, array('Q'))
+            fileid = self._file_id(filename)
+            in_order = not chunkids or not record[2] or chunkids[-1] < min(record[2])
+            for chunkid in record[2]:
+                chunkids.append(chunkid)
+                self.chunkfile[chunkid] = fileid
+                self.chunktable[chunkid] = ()
+                self.next_handle = max(self.next_handle, chunkid + 1)
+            if not in_order:
+                self.filetable[filename] = array('Q', sorted(chunkids))
+        elif op == 'delete':
+            if record[2] is None:
+                chunkids = self.filetable.pop(filename, ())
+                self._forget(filename)
+            else:
+                chunkids = set(record[2])
+                self.filetable[filename] = array('Q', [chunkid for chunkid in
+                                                       self.filetable.get(filename, ())
+                                                       if chunkid not in chunkids])
+            for chunkid in chunkids:
+                self.chunktable.pop(chunkid, None)
+                self.chunkfile.pop(chunkid, None)
+        elif op == 'rename':
+            self._move(filename, record[2])
+
+    def _log(self, *record):
+        """ Persists a metadata change, the caller holds the lock.  Callers log before they
+        change the tables and let the OSError raised when logging fails fail the call, so a
+        change is never acknowledged or made without being persisted. """
+        self.oplog.append(list(record))
+
+    def checkpoint(self):
+        """ Folds the operation log into a new checkpoint, so a restart replays only the changes
+        made after it.  The tables are packed under the lock and written outside it. """
+        self.lock.acquire()
+        try:
+            if not self.oplog.records:
+                return
+            generation = self.oplog.rotate()
+            data = msgpack.packb({
+                'generation': generation,
+                'next_handle': self.next_handle,
+                'filetable': {filename: chunkids.tobytes() for filename, chunkids
+                              in self.filetable.items() if filename != '#garbage_collection#'},
+                'chunksize': self.chunksize,
+                'compression': self.compression}, use_bin_type=True)
+        finally:
+            self.lock.release()
+
+        try:
+            self.oplog.checkpoint(generation, data)
+            print("Checkpoint %d written, %d bytes" % (generation, len(data)))
+        except Exception as e:
+            self.print_exception('writing checkpoint %d' % generation, e)
+
     def get(self, ivar):
         """
         Exposes ZMaster member variables through method access.
         :param ivar: instance variable of ZMaster
         :return:  returns the value of the instance variable
         """
+        # chunk handles are sent as strings, msgpack only takes string keys
+        if ivar == 'filetable':
+            return {filename: self.get_chunkuuids(filename) for filename in self.filetable}
+        if ivar == 'chunktable':
+            return self.see_chunkloc()
         try:
             return self.__dict__[ivar]
         except KeyError:
             self.print_exception('key error in get', KeyError)
 
     def get_chunksize(self, filename):
-        return self.chunksize[filename]
+        return self.chunksize.get(filename)
+
+    def get_compression(self, filename):
+        return self.compression.get(filename)
 
     def list(self):
         """ Returns a list of files that do not start with /hidden/deleted (marked
@@ -198,24 +516,17 @@ class ZMaster:
         """ Updates storage/network use for each chunkserver if enough time has elapsed """
         new_time = time.time()
         if new_time - self.last_updated > UPDATE_FREQUENCY:
-            jobs = []
-            for chunkserver_num, chunkclient in self.chunkclients.items():
-                thread = threading.Thread(target=self._get_stats(chunkserver_num, chunkclient))
-                jobs.append(thread)
-                thread.start()
-
-            # block until all threads are done before returning
-            for j in jobs:
-                j.join()
+            # chunkservers answer from their latest sample, so polling them in turn is quick
+            for chunkserver_num, chunkclient in list(self.chunkclients.items()):
+                self._get_stats(chunkserver_num, chunkclient)
 
             self.last_updated = new_time
 
     def _get_stats(self, chunkserver_num, chunkclient):
-        stats = chunkclient.get_stats()
-
-        # average network speed for smoother view
-        stats[0] = (stats[0] + self.chunkstats[chunkserver_num]) / 2
-        self.chunkstats[chunkserver_num] = stats
+        try:
+            self.chunkstats[chunkserver_num] = chunkclient.get_stats()
+        except Exception as e:
+            self.print_exception('getting stats of chunkserver %s' % chunkserver_num, e)
 
     # temporary functions
     def exists(self, filename):
@@ -234,49 +545,167 @@ class ZMaster:
         print('Master ack from %d' % chunknum)
 
     def get_chunkloc(self, chunkuuid):
-        return self.chunktable[chunkuuid]
+        return self.chunktable[parse_handle(chunkuuid)]
 
     # TODO temporary
     def see_chunkloc(self):
-        return self.chunktable
+        return {handle_str(chunkid): chunklocs for chunkid, chunklocs in self.chunktable.items()}
 
     def get_chunkuuids(self, filename):
-        return self.filetable[filename]
+        chunkids = self.filetable[filename]
+        if filename == '#garbage_collection#':
+            return {chunkloc: [handle_str(chunkid) for chunkid in garbage]
+                    for chunkloc, garbage in chunkids.items()}
+        return [handle_str(chunkid) for chunkid in chunkids]
 
     def get_last_chunkuuid(self, filename):
-        chunkuuid = self.filetable[filename][-1]
+        chunkuuid = handle_str(self.filetable[filename][-1])
         return chunkuuid
 
     # TODO what about same file exists?
     def update_file(self, filename, chunklist):
+        """
+        Adds written chunks to the end of a file.  Chunks that lost a replica while being
+        written are copied to other chunkservers in the background.
+        :param chunklist: [(chunkuuid, chunklocs that stored it)]
+        """
+        short = []
         self.lock.acquire()
         try:
+            chunkids = [parse_handle(chunkuuid) for chunkuuid, _ in chunklist]
+            self._log('chunks', filename, chunkids)
             if filename not in self.filetable:
-                self.filetable[filename] = []
-
-            for chunkuuid, chunkloc in chunklist:
-                self.filetable[filename].append(chunkuuid)
-                self.chunktable[chunkuuid] = chunkloc
+                self.filetable[filename] = array('Q')
+
+            reps = min(self.no_replica, len(self.chunkservers))
+            fileid = self._file_id(filename)
+            for chunkid, (_, chunkloc) in zip(chunkids, chunklist):
+                self.filetable[filename].append(chunkid)
+                self.chunkfile[chunkid] = fileid
+                self._set_chunklocs(chunkid, chunkloc)
+                if len(chunkloc) < reps:
+                    short.append(chunkid)
+            self._bump_version(filename)
+        except OSError:
+            raise  # not logged, the write fails
         except Exception as e:
             self.print_exception('updating file', e)
         finally:
             self.lock.release()
 
+        if short:
+            # copying can outlast the writer's timeout, like after report_corrupt
+            threading.Thread(target=self.replicate, args=(short,)).start()
+
+    def open(self, filename):
+        """
+        Returns everything a client needs before moving data for filename, in one call
+        :return: {'chunkuuids': ordered chunk list, 'chunktable': chunkuuid -> chunklocs,
+                  'chunksize':, 'compression':, 'version':, 'chunkservers': chunkserver num ->
+                  address of the chunkservers holding the chunks}, None if the file does not
+                  exist
+        """
+        self.lock.acquire()
+        try:
+            if filename not in self.filetable or filename == '#garbage_collection#':
+                return None
+
+            chunkuuids = self.filetable[filename]
+            chunktable = {handle_str(chunkid): list(self.chunktable[chunkid])
+                          for chunkid in chunkuuids}
+            chunkserver_nums = set(num for numlist in chunktable.values() for num in numlist)
+            return {'chunkuuids': [handle_str(chunkid) for chunkid in chunkuuids],
+                    'chunktable': chunktable,
+                    'chunksize': self.chunksize.get(filename),
+                    'compression': self.compression.get(filename),
+                    'version': self.versntable.get(filename, 0),
+                    'chunkservers': {num: self.chunkservers[num] for num in chunkserver_nums
+                                     if num in self.chunkservers}}
+        finally:
+            self.lock.release()
+
     def get_file_chunks(self, filename):
         """ Returns only relevant chunkuuids instead of entire chunktable """
         chunkuuids = self.filetable[filename]
-        file_chunks = {chunkid: self.chunktable[chunkid] for chunkid in chunkuuids}
+        file_chunks = {handle_str(chunkid): self.chunktable[chunkid] for chunkid in chunkuuids}
 
         return file_chunks
 
     ###############################################################################
 
     def updatevrsn(self, filename, flag):
-        if flag == 1:
-            self.versntable[filename] += 1
-        else:
-            self.versntable[filename] = 0
-        #print filename, self.versntable[filename]
+        """ Moves the version of filename forward.  flag is kept for old clients, which
+        asked for a reset to 0 when creating a file; versions never go back. """
+        self.lock.acquire()
+        try:
+            self._bump_version(filename)
+        finally:
+            self.lock.release()
+
+    def _bump_version(self, filename):
+        """ Marks the metadata of filename as changed so clients drop cached copies """
+        self.version_counter += 1
+        self.versntable[filename] = self.version_counter
+
+    def _forget(self, filename):
+        """ Drops the attributes of a name that no longer has a file, so deleted names do not
+        pile up in the tables and checkpoints.  Its version can go too: versions come from a
+        counter, so a file created under the name later still gets a new one. """
+        for table in (self.versntable, self.chunksize, self.compression):
+            table.pop(filename, None)
+        fileid = self.fileids.pop(filename, None)
+        if fileid is not None:
+            del self.filenames[fileid]
+
+    def _file_id(self, filename):
+        """ Returns the id of a file, giving it one on first use.  Chunks refer to their file by
+        id, so renaming a file leaves them alone, see _move """
+        fileid = self.fileids.get(filename)
+        if fileid is None:
+            fileid = self.fileids[filename] = self.next_fileid
+            self.filenames[fileid] = filename
+            self.next_fileid += 1
+        return fileid
+
+    def _chunk_file(self, chunkid):
+        """ Returns the name of the file chunkid belongs to """
+        return self.filenames[self.chunkfile[chunkid]]
+
+    def _set_chunklocs(self, chunkid, chunklocs):
+        """ Sets the replicas of chunkid, in chunktable and serverchunks """
+        self._drop_chunk(chunkid)
+        self.chunktable[chunkid] = tuple(chunklocs)
+        for chunkloc in chunklocs:
+            self.serverchunks.setdefault(chunkloc, set()).add(chunkid)
+
+    def _add_chunkloc(self, chunkid, chunkloc):
+        """ Records a new replica of chunkid on chunkloc """
+        self.chunktable[chunkid] += (chunkloc,)
+        self.serverchunks.setdefault(chunkloc, set()).add(chunkid)
+
+    def _remove_chunkloc(self, chunkid, chunkloc):
+        """ Forgets the replica of chunkid on chunkloc """
+        self.chunktable[chunkid] = tuple(c_loc for c_loc in self.chunktable[chunkid]
+                                        if c_loc != chunkloc)
+        self.serverchunks.get(chunkloc, set()).discard(chunkid)
+
+    def _drop_chunk(self, chunkid):
+        """ Forgets chunkid and all its replicas
+        :return: chunklocs it had, empty if it was not known """
+        chunklocs = self.chunktable.pop(chunkid, ())
+        for chunkloc in chunklocs:
+            self.serverchunks.get(chunkloc, set()).discard(chunkid)
+        return chunklocs
+
+    def get_version(self, filename):
+        """
+        Returns the version counter of filename, which changes whenever its chunk list or
+        chunk locations change.  Clients compare it against cached metadata.
+        :return: version, None if the file does not exist
+        """
+        if filename not in self.filetable:
+            return None
+        return self.versntable.get(filename, 0)
 
     def _establish_connection(self, chunkloc):
         """
@@ -316,35 +745,41 @@ class ZMaster:
                     chunkserver_clients = self._establish_connection(chunkloc)
 
                     if chunkserver_clients != False:
-                        # print "call delchunkfile fn() in chunkserver-"+str(chunkloc)
-                        flag = chunkserver_clients.delete(list(set(chunklocs[chunkloc])))
-                        if flag:
-                            # remove chunkid if present in failedservers
-                            for chunkid in list(set(chunklocs[chunkloc])):
-                                i = 0
-                                while i < len(failedservers):
-                                    if chunkid in chunklocs[failedservers[i]]:
-                                        chunklocs[failedservers[i]].remove(chunkid)
-                                        if chunklocs[failedservers[i]] == []:
-                                            del self.filetable["#garbage_collection#"][
-                                                failedservers[i]]
-                                            failedservers.remove(failedservers[i])
-                                        break
-                                    i += 1
-
-                            # print "remove value from garbage collection for "+str(chunkloc)
-                            del self.filetable["#garbage_collection#"][chunkloc]
+                        # the chunkserver unlinks in the background, so one call clears all
+                        chunkids = set(chunklocs[chunkloc])
+                        counts = chunkserver_clients.delete([handle_str(chunkid)
+                                                             for chunkid in chunkids])
+                        chunkserver_clients.close()
+                        print("Collected %d chunks on %s, %d already gone" % (
+                            counts['deleted'], chunkloc, counts['missing']))
+
+                        # remove chunkids if present in failedservers
+                        for failedserver in failedservers:
+                            if failedserver not in chunklocs:
+                                continue
+                            chunklocs[failedserver] = [chunkid for chunkid in chunklocs[failedserver]
+                                                       if chunkid not in chunkids]
+                            if not chunklocs[failedserver]:
+                                del self.filetable["#garbage_collection#"][failedserver]
+
+                        # print "remove value from garbage collection for "+str(chunkloc)
+                        del self.filetable["#garbage_collection#"][chunkloc]
 
                     else:
                         print("Failed to connect to ", chunkloc)
         else:
             print("nothing to clear in garbage")
 
-    def replicate(self):
-        # print "In replicate"
+    def replicate(self, chunkids=None):
+        """
+        Copies chunks with fewer than no_replica replicas to more chunkservers.  Copies are
+        planned under the lock, made without it so the master keeps serving meanwhile, and
+        recorded under it again.
+        :param chunkids: chunks to check, e.g. those of a lost chunkserver; every chunk if None
+        """
+        copies = []  # (chunkid, source chunklocs, target chunkloc, filename)
         self.lock.acquire()
         try:
-            replicas = {}
             no_servers = len(self.chunkservers)
 
             # skip checking for copies if we have 0 chunkservers
@@ -354,50 +789,61 @@ class ZMaster:
 
             reps = min(self.no_replica, no_servers)
 
-            chunktable = self.chunktable
-            chunkserver = {}
-            values = []
+            if chunkids is None:
+                chunktable = self.chunktable
+            else:
+                chunktable = {chunkid: self.chunktable[chunkid] for chunkid in chunkids
+                              if chunkid in self.chunktable}
+            keys_list = list(self.chunkservers.keys())
             for chunkid, values in list(chunktable.items()):
-                temp = str(values)
-                values = ast.literal_eval(temp)
-                keys_list = list(self.chunkservers.keys())
+                if not values:
+                    continue  # nothing to copy from until a chunkserver reports the chunk
+                sources = str(list(values))
+                values = list(values)
                 while len(values) < reps:
                     self.chunkrobin = (self.chunkrobin + 1) % self.num_chunkservers
                     chunkloc = keys_list[self.chunkrobin]
                     while chunkloc in values:
                         self.chunkrobin = (self.chunkrobin + 1) % self.num_chunkservers
                         chunkloc = keys_list[self.chunkrobin]
+                    copies.append((chunkid, sources, chunkloc, self._chunk_file(chunkid)))
+                    values.append(chunkloc)
+        except Exception as e:
+            self.print_exception('planning replicate', e)
+            return None
+        finally:
+            self.lock.release()
 
-                    # print "call connection to "+str(chunkloc)+" pass ",chunkid,temp
-                    if chunkloc not in chunkserver:
-                        try:
-                            chunkserver[chunkloc] = self._establish_connection(chunkloc)
-                        except Exception as e:
-                            self.print_exception('in replicate', e)
-
-                    if chunkserver[chunkloc].copy_chunk(chunkid, temp):
-                        #print "Update chunktable"
-                        self.chunktable[chunkid].append(chunkloc)
-
-                    result = {}
-                    result[chunkid] = temp
-                    try:
-                        replicas[chunkloc].append(result)
-                    except:
-                        replicas[chunkloc] = []
-                        replicas[chunkloc].append(result)
+        if not copies:
+            print("Nothing to do in replicate")
+            return None
 
-                    values.append(chunkloc)
+        chunkserver = {}
+        copied = []
+        for chunkid, sources, chunkloc, filename in copies:
+            try:
+                if chunkloc not in chunkserver:
+                    chunkserver[chunkloc] = self._establish_connection(chunkloc)
+                if chunkserver[chunkloc].copy_chunk(handle_str(chunkid), sources, filename):
+                    copied.append((chunkid, chunkloc))
+            except Exception as e:
+                self.print_exception('copying chunk %s to %s' % (handle_str(chunkid), chunkloc), e)
+        for client in chunkserver.values():
+            if client:
+                client.close()
 
-            if len(replicas) == 0:
-                print("Nothing to do in replicate")
-            else:
-                # print "replica: ", replicas
-                print("replicated %d items " % len(list(replicas.keys())))
-        except Exception as e:
-            self.print_exception('acquiring lock in replicate', e)
+        self.lock.acquire()
+        try:
+            for chunkid, chunkloc in copied:
+                # the chunk may have been deleted, or the target lost, during the copy
+                if chunkloc in self.chunkservers and \
+                        chunkloc not in self.chunktable.get(chunkid, (chunkloc,)):
+                    self._add_chunkloc(chunkid, chunkloc)
+                    self._bump_version(self._chunk_file(chunkid))
         finally:
             self.lock.release()
+        print("replicated %d of %d chunk copies" % (len(copied), len(copies)))
+        return None
 
     def delete(self, filename, chunkuuids):  # rename for later garbage collection
 
@@ -405,7 +851,11 @@ class ZMaster:
         try:
             if chunkuuids == "":
                 chunkuuids = self.filetable[filename]
+                self._log('delete', filename, None)
                 del self.filetable[filename]
+                self._forget(filename)
+            else:
+                self._log('delete', filename, sorted(chunkuuids))
 
             deleted_filename = "#garbage_collection#"
 
@@ -417,17 +867,19 @@ class ZMaster:
                 # self.filetable[deleted_filename]=[]
 
             for chunkid in chunkuuids:
-                chunklocs = self.get_chunkloc(chunkid)
+                chunklocs = self._drop_chunk(chunkid)
+                self.chunkfile.pop(chunkid, None)
                 for chunkloc in chunklocs:
                     try:
                         self.filetable[deleted_filename][chunkloc].append(chunkid)
                     except:
                         self.filetable[deleted_filename][chunkloc] = []
                         self.filetable[deleted_filename][chunkloc].append(chunkid)
-                del self.chunktable[chunkid]
 
             #print self.filetable[deleted_filename]
             # self.collect_garbage()
+        except OSError:
+            raise  # not logged, nothing was deleted
         except Exception as e:
             print("Unexpected error in delete:")
             print(e.__doc__, e.message)
@@ -439,102 +891,234 @@ class ZMaster:
         self.lock.acquire()
         try:
             #print filename, chunk_rm_ids
+            chunk_rm_ids = set(parse_handle(chunkid) for chunkid in chunk_rm_ids)
             chunkuuids = self.filetable[filename]
-            self.filetable[filename] = [x for x in chunkuuids if x not in chunk_rm_ids]
-            self.delete(filename, chunk_rm_ids)
+            self.delete(filename, chunk_rm_ids)  # logs the removal first
+            self.filetable[filename] = array('Q', [x for x in chunkuuids if x not in chunk_rm_ids])
+            self._bump_version(filename)
+        except OSError:
+            raise
         except Exception as e:
             self.print_exception('delete_chunks', e)
         finally:
             self.lock.release()
 
+    def report_corrupt(self, chunkloc, chunkuuids):
+        """
+        Drops replicas a chunkserver found corrupt and re-replicates the chunks from their
+        good copies.  The last replica of a chunk is kept, parts of it may still be readable.
+        :param chunkloc: chunkserver that found the corruption
+        :param chunkuuids: corrupt chunks on that chunkserver
+        :return:  chunkuuids the chunkserver should discard
+        """
+        dropped = []
+        self.lock.acquire()
+        try:
+            for chunkuuid in chunkuuids:
+                try:
+                    chunkid = parse_handle(chunkuuid)
+                except ValueError:
+                    continue  # legacy id that could not be migrated, not tracked by the master
+                chunklocs = self.chunktable.get(chunkid, [])
+                if chunkloc not in chunklocs:
+                    continue
+                if len(chunklocs) == 1:
+                    print("Only replica of %s on %s is corrupt" % (chunkuuid, chunkloc))
+                    continue
+                self._remove_chunkloc(chunkid, chunkloc)
+                self._bump_version(self._chunk_file(chunkid))
+                dropped.append(chunkuuid)
+        except Exception as e:
+            self.print_exception('report corrupt', e)
+        finally:
+            self.lock.release()
+
+        if dropped:
+            print("Dropped %d corrupt replicas on %s" % (len(dropped), chunkloc))
+            # copying can outlast the caller's timeout, so it runs like the scheduled replicate
+            threading.Thread(target=self.replicate,
+                             args=([parse_handle(chunkuuid) for chunkuuid in dropped],)).start()
+        return dropped
+
+    def report_stale(self, chunkuuid, chunklocs):
+        """
+        Drops replicas of a chunk that a client's overwrite did not reach, so they are not
+        served with the old contents, and copies the chunk from the replicas that have it
+        before answering
+        :param chunklocs: replicas the overwrite missed
+        :return: chunklocs of the chunk afterwards
+        """
+        chunkid = parse_handle(chunkuuid)
+        self.lock.acquire()
+        try:
+            if chunkid not in self.chunktable:
+                return []
+            for chunkloc in chunklocs:
+                if chunkloc in self.chunktable[chunkid]:
+                    self._remove_chunkloc(chunkid, chunkloc)
+            self._bump_version(self._chunk_file(chunkid))
+        finally:
+            self.lock.release()
+
+        print("Dropped %d stale replicas of %s" % (len(chunklocs), chunkuuid))
+        self.replicate([chunkid])
+        return list(self.chunktable.get(chunkid, ()))
+
     def next_chunkloc(self, keys_list, num_items):
         next_chunklocs = random.sample(keys_list, num_items)
         return next_chunklocs
 
-    def alloc2(self, filename, num_chunks, chunksize, seq):  # return ordered chunk map to server
-        chunks = self.alloc2_chunks(num_chunks, filename, seq)
+    def _new_handles(self, num_chunks):
+        """ Returns num_chunks fresh chunk handles, in increasing order """
+        with self.handle_lock:
+            first = self.next_handle
+            self.next_handle += num_chunks
+        return range(first, first + num_chunks)
+
+    def alloc2(self, filename, num_chunks, chunksize, compression=None):  # return ordered chunk map to server
+        chunks = self.alloc2_chunks(num_chunks, filename)
         # self.filetable[filename] = chunks  don't update filetable until writing successful
-        self.chunksize[filename] = chunksize
+        self.lock.acquire()
+        try:
+            self._log('file', filename, chunksize, compression or None)
+            self.chunksize[filename] = chunksize
+            if compression:
+                self.compression[filename] = compression
+            else:
+                self.compression.pop(filename, None)
+        finally:
+            self.lock.release()
         return chunks
 
-    def alloc2_chunks(self, num_chunks, filename, seq):
+    def alloc2_chunks(self, num_chunks, filename):
 
         if self.num_chunkservers == 0:
             return None
 
         # chunkuuids = {}
         chunkuuids = []
-        tseq = seq
         keys_list = list(self.chunkservers.keys())
-        for i in range(0, num_chunks):
-            chunkuuid = filename + "$%#" + str(tseq) + "$%#" + str(uuid.uuid1())
-
+        for chunkid in self._new_handles(num_chunks):
             if len(keys_list) < 3:
                 num_chunklocs = len(keys_list)
             else:
                 num_chunklocs = 3
 
             next_chunklocs = self.next_chunkloc(keys_list, num_chunklocs)
-            chunkuuids.append((chunkuuid, next_chunklocs))
-            tseq += 1
+            chunkuuids.append((handle_str(chunkid), next_chunklocs))
 
         return chunkuuids
 
-    def alloc(self, filename, num_chunks, chunksize, seq):  # return ordered chunk list
-        chunks = self.alloc_chunks(num_chunks, filename, seq)
-        self.filetable[filename] = chunks
-        self.chunksize[filename] = chunksize
+    def alloc(self, filename, num_chunks, chunksize):  # return ordered chunk list
+        chunks = self.alloc_chunks(num_chunks, filename)
+        self.lock.acquire()
+        try:
+            chunkids = array('Q', [parse_handle(chunkid) for chunkid in chunks])
+            self._log('file', filename, chunksize, None)
+            self._log('chunks', filename, list(chunkids))
+            self.filetable[filename] = chunkids
+            self.chunksize[filename] = chunksize
+        finally:
+            self.lock.release()
         return chunks
 
-    def alloc_chunks(self, num_chunks, filename, seq):
+    def alloc_chunks(self, num_chunks, filename):
         chunkuuids = []
-        tseq = seq
         keys_list = list(self.chunkservers.keys())
-        for i in range(0, num_chunks):
-            chunkuuid = filename + "$%#" + str(tseq) + "$%#" + str(uuid.uuid1())
+        fileid = self._file_id(filename)
+        for chunkid in self._new_handles(num_chunks):
             chunkloc = self.chunkrobin
-            self.chunktable[chunkuuid] = [keys_list[chunkloc]]
-            chunkuuids.append(chunkuuid)
+            self._set_chunklocs(chunkid, [keys_list[chunkloc]])
+            self.chunkfile[chunkid] = fileid
+            chunkuuids.append(handle_str(chunkid))
             self.chunkrobin = (self.chunkrobin + 1) % self.num_chunkservers
-            tseq += 1
         return chunkuuids
 
-    def alloc_append(self, num_append_chunks, filename, seq):  # append chunks
+    def alloc_append(self, num_append_chunks, filename):  # append chunks
         chunkuuids = self.filetable[filename]
-        tseq = seq
-        append_chunkuuids = self.alloc_chunks(num_append_chunks, filename, tseq)
-        chunkuuids.extend(append_chunkuuids)
+        append_chunkuuids = self.alloc_chunks(num_append_chunks, filename)
+        chunkids = [parse_handle(chunkid) for chunkid in append_chunkuuids]
+        self.lock.acquire()
+        try:
+            self._log('chunks', filename, chunkids)
+            chunkuuids.extend(chunkids)
+        finally:
+            self.lock.release()
         return append_chunkuuids
 
-    def rename(self, result, filename, newfilename):
+    def rename(self, filename, newfilename):
+        """
+        Renames a file.  Only the namespace changes: chunks are named by handle and refer to
+        their file by id, so they stay where they are.  The file hints kept with the chunks
+        are updated afterwards, by the hint thread.
+        :return: whether the file was renamed
+        """
         self.lock.acquire()
         try:
-            chunkserver = {}
-            chunkids = []
-            flag = True
-            for chunkloc, chunkids in list(result.items()):
-                try:
-                    chunkserver[chunkloc] = self._establish_connection(chunkloc)
-                except:
-                    print("Couldnt connect to chunkserver ", chunkloc)
-
-                flag = True
-                no_keys = len(chunkids)
-                flag = flag and chunkserver[chunkloc].rename(chunkids, filename, newfilename)
-
-            if flag:
-                for chunkid in self.filetable[filename]:
-                    temp = str(chunkid).replace(filename, newfilename)
-                    self.chunktable[temp] = self.chunktable.pop(chunkid)
-                self.filetable[newfilename] = ast.literal_eval(
-                    str(self.filetable.pop(filename)).replace(filename, newfilename))
-                self.versntable[newfilename] = self.versntable.pop(filename)
-            else:
-                print("Some error occurred while renaming")
+            if filename not in self.filetable or filename == '#garbage_collection#':
+                print("Can't rename, file %s does not exist" % filename)
+                return False
+            if newfilename in self.filetable:
+                print("Can't rename, file %s already exists" % newfilename)
+                return False
+
+            self._log('rename', filename, newfilename)
+            self._move(filename, newfilename)
+            if newfilename in self.fileids:
+                self.hint_queue.put(self.fileids[newfilename])
+        except OSError:
+            raise  # not logged, not renamed
         except Exception as e:
             self.print_exception('rename', e)
+            return None
         finally:
             self.lock.release()
+        return True
+
+    def _update_hints_forever(self):
+        """ Hint thread: brings the hints of renamed files up to date.  A file is looked up by
+        id when its turn comes, so after several renames its chunks get its latest name. """
+        while True:
+            fileid = self.hint_queue.get()
+            self.lock.acquire()
+            try:
+                filename = self.filenames.get(fileid)
+                by_chunkserver = {}
+                if filename is not None:
+                    for chunkid in self.filetable[filename]:
+                        for chunkloc in self.chunktable[chunkid]:
+                            by_chunkserver.setdefault(chunkloc, []).append(handle_str(chunkid))
+            except Exception as e:
+                self.print_exception('collecting hints', e)
+                continue
+            finally:
+                self.lock.release()
+            self._update_hints(filename, by_chunkserver)
+
+    def _update_hints(self, filename, by_chunkserver):
+        """ Points the hints of chunks at the file they now belong to, so a master rebuilding
+        its namespace from chunkservers finds them under that name
+        :param by_chunkserver: chunkloc -> chunkuuids stored there """
+        for chunkloc, chunkuuids in by_chunkserver.items():
+            try:
+                chunkserver = self._establish_connection(chunkloc)
+                chunkserver.set_hints(chunkuuids, filename)
+                chunkserver.close()
+            except Exception as e:
+                self.print_exception('updating hints on chunkserver %s' % chunkloc, e)
+
+    def _move(self, filename, newfilename):
+        """ Moves a file and its attributes to a new name, the caller holds the lock """
+        self.filetable[newfilename] = self.filetable.pop(filename)
+        fileid = self.fileids.pop(filename, None)
+        if fileid is not None:
+            self.fileids[newfilename] = fileid
+            self.filenames[fileid] = newfilename
+        self._bump_version(newfilename)
+        for table in (self.chunksize, self.compression):
+            if filename in table:
+                table[newfilename] = table.pop(filename)
+        self._forget(filename)
 
     def dump_metadata(self):
         print("Filetable:", end=' ')
@@ -551,86 +1135,104 @@ class ZMaster:
     def rm_from_ctable(self, chunkloc):
         self.lock.acquire()
         try:
-            for values in self.chunktable.values():
-                values.remove(chunkloc)
+            for chunkid in self.serverchunks.pop(chunkloc, set()):
+                self._remove_chunkloc(chunkid, chunkloc)
         except Exception as e:
             self.print_exception('rm from ctable', e)
         finally:
             self.lock.release()
 
     def sort_filetable(self, filename):
+        """ Puts the chunks of a file in order.  Handles are allocated in increasing order as
+        a file grows, so that is their numeric order. """
 
         self.lock.acquire()
         try:
-            temp = []
-            temptable = {}
-
-            for fileid in self.filetable[filename]:
-                temptable[fileid.split("$%#")[1]] = fileid
-
-            keys = sorted(temptable.keys())
-            for key in keys:
-                temp.append(temptable[key])
-            self.filetable[filename] = temp
+            self.filetable[filename] = array('Q', sorted(self.filetable[filename]))
         except Exception as e:
             self.print_exception('sort filetable', e)
         finally:
             self.lock.release()
 
+    def _adoptable(self, filename, chunkid):
+        """ Whether an unknown chunk reported with filename as its hint is added to that file.
+        A restored master knows every chunk written since, only legacy chunks migrated by a
+        chunkserver that was away can be missing from a file it has. """
+        if not filename:
+            return False
+        if not self.restored:
+            return True
+        chunkids = self.filetable.get(filename)
+        # migrated chunks have the lowest handles of their file, sharing the filename prefix
+        return chunkid >> LEGACY_HANDLE_BITS == 0 and bool(chunkids) and \
+            chunkids[0] >> LEGACY_SEQ_BITS == chunkid >> LEGACY_SEQ_BITS
+
     def populate(self, files, chunkloc):
+        """
+        Takes in the chunks a registering chunkserver stores.  Known chunks gain chunkloc as a
+        replica, up to no_replica.  Unknown chunks are added to the file the chunkserver
+        created them for, in handle order, unless metadata was restored from the operation
+        log (see _adoptable).  Surplus replicas and chunks awaiting garbage collection are
+        collected; chunks still stored under pre-handle ids are left alone.
+        :param files: filename the chunks were created for -> chunk handles
+        :param chunkloc: the registering chunkserver
+        """
 
         self.lock.acquire()
         try:
             # print files, chunkloc, "in master"
-            for filename, chunkids in list(files.items()):
-                if self.exists(filename):
-                    print("operations for merging")
-                    for chunkid in chunkids:
-                        if chunkid not in self.filetable[filename] and chunkid not in [list(x)[0]
-                                                                                       for x in set(
-                                tuple(x) for x in
-                                list(self.filetable['#garbage_collection#'].values()))]:
-                            if True:  # condition to check if hash for chunkids are the same
-                                self.filetable[filename].append(chunkid)
-                                self.chunktable[chunkid] = [chunkloc]
-                        else:
-                            if len(self.chunktable[
-                                       chunkid]) < self.no_replica:  # also check if data is the same
-                                self.chunktable[chunkid].append(chunkloc)
-                            else:
-                                try:
-                                    self.filetable['#garbage_collection#'][chunkloc].append(chunkid)
-                                except:
-
-                                    self.filetable['#garbage_collection#'][chunkloc] = [chunkid]
-                else:
-                    orig_chunkids = chunkids[:]
-                    chunkids = list(set(chunkids) - set([list(x)[0] for x in set(
-                        tuple(x) for x in list(self.filetable['#garbage_collection#'].values()))]))
-                    #print "chunkids", chunkids
-                    if chunkids != []:
-                        print("operation for adding", filename)
-                        self.filetable[filename] = chunkids
-                        temp = {}
-                        for chunkid in chunkids:
-                            temp[chunkid] = [chunkloc]
-                        self.chunktable.update(temp)
-                        self.versntable[filename] = 1
-                        # update chunksize table
-                    else:
-                        print("operation for deleting", list(set(orig_chunkids) - set(chunkids)))
-
-                    for chunkid in list(set(orig_chunkids) - set(chunkids)):
-                        try:
-                            self.filetable['#garbage_collection#'][chunkloc].append(chunkid)
-                        except:
-                            self.filetable['#garbage_collection#'][chunkloc] = [chunkid]
-
-                if self.exists(filename):
-                    self.sort_filetable(filename)
-
-                    # print self.filetable
-                    # print self.chunktable
+            garbage_table = self.filetable['#garbage_collection#']
+            garbage = set(chunkid for chunkids in garbage_table.values() for chunkid in chunkids)
+            changed = set()
+            adopted = {}  # filename -> unknown chunks added to it
+            ignored = 0
+            for filename, chunkuuids in list(files.items()):
+                for chunkuuid in chunkuuids:
+                    try:
+                        chunkid = parse_handle(chunkuuid)
+                    except ValueError:
+                        ignored += 1
+                        continue
+                    with self.handle_lock:
+                        self.next_handle = max(self.next_handle, chunkid + 1)
+
+                    chunklocs = self.chunktable.get(chunkid)
+                    if chunklocs is not None:
+                        if chunkloc in chunklocs:
+                            continue
+                        if len(chunklocs) < self.no_replica:  # also check if data is the same
+                            self._add_chunkloc(chunkid, chunkloc)
+                            changed.add(self._chunk_file(chunkid))
+                            continue
+                    elif chunkid not in garbage and self._adoptable(filename, chunkid):
+                        adopted.setdefault(filename, []).append(chunkid)
+                        continue
+
+                    garbage_table.setdefault(chunkloc, []).append(chunkid)
+
+            # adopted chunks are logged before they join their files
+            for filename, chunkids in adopted.items():
+                self._log('chunks', filename, chunkids)
+                if filename not in self.filetable:
+                    print("operation for adding", filename)
+                    self.filetable[filename] = array('Q')
+                fileid = self._file_id(filename)
+                for chunkid in chunkids:
+                    self.filetable[filename].append(chunkid)
+                    self.chunkfile[chunkid] = fileid
+                    self._set_chunklocs(chunkid, [chunkloc])
+                changed.add(filename)
+
+            for filename in changed:
+                self.sort_filetable(filename)
+                self._bump_version(filename)
+            if ignored:
+                print("Ignored %d chunks on %s stored under pre-handle ids" % (ignored, chunkloc))
+        except OSError:
+            # the registration fails, so the chunkserver's replicas are forgotten until it
+            # registers again
+            self.rm_from_ctable(chunkloc)
+            raise
         except Exception as e:
             self.print_exception('populate', e)
         finally:
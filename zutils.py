@@ -35,6 +35,250 @@ def get_client():
     return client
 
 
+def watch_chunkservers(zookeeper, pool, path='chunkserver/'):
+    """ Keeps a ConnectionPool in step with chunkservers joining and leaving zookeeper """
+    from kazoo.exceptions import NoNodeError
+
+    @zookeeper.ChildrenWatch(path)
+    def watch_children(children):
+        chunkservers = {}
+        for chunkserver_num in children:
+            try:
+                data = zookeeper.get(path + chunkserver_num)[0].decode()
+            except NoNodeError:
+                continue
+            # ip is set right after the node is created, until then keep the old address
+            if data:
+                chunkservers[chunkserver_num] = data.split('@')[-1]
+            elif chunkserver_num in pool:
+                chunkservers[chunkserver_num] = pool.addresses[chunkserver_num]
+        pool.update(chunkservers)
+
+
+def parse_compression(compression):
+    """
+    Checks a per-file compression setting, 'zlib' or 'lzma' optionally followed by a level,
+    e.g. 'zlib:6' or 'lzma:1'.
+    :return: (codec, level), level None for the codec's default, None if compression is off
+    """
+    if not compression:
+        return None
+    codec, _, level = compression.partition(':')
+    if codec not in ('zlib', 'lzma'):
+        raise ValueError('unknown compression codec %r' % codec)
+    return codec, int(level) if level else None
+
+
+def compress(data, compression):
+    """ Compresses a bytes-like chunk with a setting accepted by parse_compression """
+    import lzma
+    import zlib
+
+    codec, level = parse_compression(compression)
+    if codec == 'zlib':
+        return zlib.compress(data, -1 if level is None else level)
+    return lzma.compress(data, preset=level)
+
+
+def decompress(data, compression):
+    """ Reverses compress """
+    import lzma
+    import zlib
+
+    codec, _ = parse_compression(compression)
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    return lzma.decompress(data)
+
+
+class ConnectionPool:
+    """ Long-lived zerorpc clients keyed by chunkserver number.  Clients are connected on
+    first use and kept until the chunkserver leaves or changes address. """
+
+    def __init__(self, directory=None):
+        """
+        :param directory: callable returning the full {chunkserver_num: address} map, asked
+        when a chunkserver that is not known yet is requested
+        """
+        import threading
+
+        self.lock = threading.RLock()
+        self.addresses = {}  # chunkserver num -> tcp address
+        self.clients = {}  # chunkserver num -> connected zerorpc client
+        self.retired = []  # clients of departed chunkservers, closed on next use of the pool
+        self.directory = directory
+
+    def update(self, addresses, complete=True):
+        """
+        Syncs membership with addresses.  Safe to call from zookeeper watch threads, clients
+        are only closed from the thread using the pool.
+        :param addresses: {chunkserver_num: address}
+        :param complete: addresses holds every live chunkserver, drop the ones not in it
+        """
+        with self.lock:
+            for chunkserver_num, address in addresses.items():
+                if self.addresses.get(chunkserver_num) != address:
+                    self._retire(chunkserver_num)
+                    self.addresses[chunkserver_num] = address
+            if complete:
+                for chunkserver_num in list(self.addresses):
+                    if chunkserver_num not in addresses:
+                        self._retire(chunkserver_num)
+                        del self.addresses[chunkserver_num]
+
+    def _retire(self, chunkserver_num):
+        client = self.clients.pop(chunkserver_num, None)
+        if client is not None:
+            self.retired.append(client)
+
+    def get(self, chunkserver_num):
+        """
+        :return: zerorpc client connected to chunkserver_num
+        :raises KeyError: chunkserver_num is not a live chunkserver
+        """
+        import zerorpc
+
+        with self.lock:
+            while self.retired:
+                self.retired.pop().close()
+
+            client = self.clients.get(chunkserver_num)
+            if client is None:
+                if chunkserver_num not in self.addresses and self.directory:
+                    self.update(self.directory())
+                client = zerorpc.Client()
+                client.connect(self.addresses[chunkserver_num])
+                self.clients[chunkserver_num] = client
+            return client
+
+    __getitem__ = get
+
+    def __contains__(self, chunkserver_num):
+        return chunkserver_num in self.addresses
+
+    def close(self):
+        with self.lock:
+            for client in self.retired + list(self.clients.values()):
+                client.close()
+            self.retired = []
+            self.clients = {}
+
+
+class MetadataCache:
+    """ LRU cache of per-file metadata tagged with the master's version counter.  Entries
+    younger than ttl seconds are trusted as is, older ones must be revalidated. """
+
+    def __init__(self, capacity=1024, ttl=5.0):
+        import collections
+
+        self.capacity = capacity
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()  # filename -> (version, fetched at, metadata)
+
+    def get(self, filename):
+        """
+        :return: (version, fresh, metadata), fresh is False once the ttl has run out.
+                 None if filename is not cached
+        """
+        import time
+
+        entry = self.entries.get(filename)
+        if entry is None:
+            return None
+        self.entries.move_to_end(filename)
+        version, fetched, metadata = entry
+        return version, time.time() - fetched < self.ttl, metadata
+
+    def put(self, filename, version, metadata):
+        import time
+
+        self.entries[filename] = (version, time.time(), metadata)
+        self.entries.move_to_end(filename)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def touch(self, filename):
+        """ Restarts the ttl of an entry the master confirmed is still current """
+        version, _, metadata = self.entries[filename]
+        self.put(filename, version, metadata)
+
+    def invalidate(self, filename):
+        self.entries.pop(filename, None)
+
+
+class LatencyTracker:
+    """ Moving latency and error estimates per chunkserver.  Replicas are ranked by expected
+    cost, and a latency percentile over recent requests gives the deadline for hedging. """
+
+    def __init__(self, alpha=0.2, window=512, percentile=95, min_samples=20):
+        import collections
+
+        self.alpha = alpha  # weight of the newest sample in the moving averages
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.latency = {}  # chunkserver num -> moving average latency in seconds
+        self.errors = {}  # chunkserver num -> moving average error rate in [0, 1]
+        self.samples = collections.deque(maxlen=window)  # recent latencies of all chunkservers
+
+    def record(self, chunkserver_num, seconds):
+        previous = self.latency.get(chunkserver_num, seconds)
+        self.latency[chunkserver_num] = previous + self.alpha * (seconds - previous)
+        self.errors[chunkserver_num] = (1 - self.alpha) * self.errors.get(chunkserver_num, 0.)
+        self.samples.append(seconds)
+
+    def record_error(self, chunkserver_num):
+        previous = self.errors.get(chunkserver_num, 0.)
+        self.errors[chunkserver_num] = previous + self.alpha * (1 - previous)
+
+    def cost(self, chunkserver_num):
+        """ Expected seconds to get an answer.  Unmeasured chunkservers cost nothing, so
+        they are tried and measured. """
+        latency = self.latency.get(chunkserver_num, 0.)
+        # an error costs roughly a timeout, approximated by the slowest recent latency
+        penalty = max(self.samples) if self.samples else 1.
+        return latency + self.errors.get(chunkserver_num, 0.) * max(penalty, latency)
+
+    def rank(self, chunkserver_nums):
+        """ Returns chunkserver_nums ordered cheapest first, ties in random order """
+        import random
+
+        ranked = list(chunkserver_nums)
+        random.shuffle(ranked)
+        ranked.sort(key=self.cost)
+        return ranked
+
+    def deadline(self):
+        """ Returns the latency percentile of recent requests in seconds, None until enough
+        requests have been measured """
+        if len(self.samples) < self.min_samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, len(ordered) * self.percentile // 100)]
+
+
+class RateLimiter:
+    """ Paces a consumer to rate bytes per second.  Unused allowance carries over for at
+    most one second, so a paused consumer cannot burst afterwards. """
+
+    def __init__(self, rate):
+        import time
+
+        self.rate = rate
+        self.allowance = rate
+        self.last = time.time()
+
+    def consume(self, nbytes):
+        """ Accounts for nbytes, sleeping the calling thread until they fit in the rate """
+        import time
+
+        now = time.time()
+        self.allowance = min(self.allowance + (now - self.last) * self.rate, self.rate)
+        self.last = now
+        self.allowance -= nbytes
+        if self.allowance < 0:
+            time.sleep(-self.allowance / self.rate)
+
+
 # def get_mem(servername):
     # res = os.popen('ssh %s "grep MemFree /proc/meminfo | sed \'s/[^0-9]//g\'"' % servername)
     # return res.read().strip()